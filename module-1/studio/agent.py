@@ -1,10 +1,16 @@
-from langchain_core.messages import SystemMessage
+import os
+from typing import Annotated
+
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately
 # from langchain_openai import ChatOpenAI
 from langchain_ollama import ChatOllama
 
 from langgraph.graph import START, StateGraph, MessagesState
 from langgraph.prebuilt import tools_condition, ToolNode
 
+from cassette import use_cassette
+
 def add(a: int, b: int) -> int:
     """Adds a and b.
 
@@ -35,19 +41,58 @@ def divide(a: int, b: int) -> float:
 tools = [add, multiply, divide]
 
 # Define LLM with bound tools
-llm = ChatOllama( model="llama3.1-tool", temperature=0,base_url="http://host.docker.internal:11434") # other params...)
+llm = use_cassette(ChatOllama( model="llama3.1-tool", temperature=0,base_url="http://host.docker.internal:11434")) # other params...)
 # llm = ChatOpenAI(model="gpt-4o")
 llm_with_tools = llm.bind_tools(tools)
 
 # System message
 sys_msg = SystemMessage(content="You are a helpful assistant tasked with writing performing arithmetic on a set of inputs.")
 
+# Token budget for the history sent with each call, so long tool outputs do not grow the prompt without bound
+max_history_tokens = int(os.getenv("MAX_HISTORY_TOKENS", "8000"))
+
+# merge_token_counts and trim_history are copied in the module-1, module-2 and module-3 studios; keep the copies identical
+def merge_token_counts(left: dict, right: dict) -> dict:
+    """Token counts by message id; a count of None drops the entry."""
+    merged = {**left, **right}
+    return {id: count for id, count in merged.items() if count is not None}
+
+# Messages plus the token count of each message, computed once per message id
+class State(MessagesState):
+    token_counts: Annotated[dict, merge_token_counts]
+
+def trim_history(messages: list, token_counts: dict, max_tokens: int) -> list:
+
+    """The most recent messages that fit in max_tokens, starting on a human message."""
+
+    kept, total = [], 0
+    for message in reversed(messages):
+        total += token_counts.get(message.id, 0)
+        if total > max_tokens:
+            break
+        kept.append(message)
+    kept.reverse()
+
+    # Start on a human message, so no tool result or reply is cut off from what it answers
+    while kept and not isinstance(kept[0], HumanMessage):
+        kept.pop(0)
+
+    # If even the latest exchange is over budget, keep it whole
+    if not kept:
+        last_human = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=0)
+        kept = messages[last_human:]
+    return kept
+
 # Node
-def assistant(state: MessagesState):
-   return {"messages": [llm_with_tools.invoke([sys_msg] + state["messages"])]}
+def assistant(state: State):
+   # Count only the messages added since the last call
+   cached = state.get("token_counts", {})
+   new_token_counts = {m.id: count_tokens_approximately([m]) for m in state["messages"] if m.id not in cached}
+   history = trim_history(state["messages"], {**cached, **new_token_counts}, max_history_tokens - count_tokens_approximately([sys_msg]))
+   return {"messages": [llm_with_tools.invoke([sys_msg] + history)], "token_counts": new_token_counts}
 
 # Build graph
-builder = StateGraph(MessagesState)
+builder = StateGraph(State)
 builder.add_node("assistant", assistant)
 builder.add_node("tools", ToolNode(tools))
 builder.add_edge(START, "assistant")
@@ -0,0 +1,154 @@
+# Copy of module-4/studio/cassette.py, as each studio directory is deployed on its own; keep the two in sync
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Optional
+
+from pydantic import ConfigDict
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import messages_from_dict, message_to_dict
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+class Cassette:
+
+    """ Record model and retriever responses to a local JSONL file keyed by request hash, and replay them offline """
+
+    def __init__(self, path: str, mode: str = "replay", latency: str = "none"):
+        # mode is "record" (call through and save) or "replay" (serve saved responses only)
+        # latency is "none", "recorded", "fixed:<s>", "uniform:<lo>,<hi>" or "lognormal:<mu>,<sigma>"
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry
+
+    @staticmethod
+    def key(kind: str, request: Any) -> str:
+        payload = json.dumps({"kind": kind, "request": request}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _record(self, key: str, kind: str, response: Any, duration: float):
+        entry = {"key": key, "kind": kind, "response": response, "duration": duration}
+        with self._lock:
+            self.entries[key] = entry
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def _lookup(self, key: str, kind: str) -> dict:
+        if key not in self.entries:
+            raise KeyError(f"No recorded {kind} response for request {key} in {self.path}")
+        return self.entries[key]
+
+    def simulated_latency(self, entry: dict) -> float:
+        name, _, args = self.latency.partition(":")
+        params = [float(value) for value in args.split(",") if value]
+        if name == "recorded":
+            return entry["duration"]
+        if name == "fixed":
+            return params[0]
+        if name == "uniform":
+            return random.uniform(*params)
+        if name == "lognormal":
+            return random.lognormvariate(*params)
+        return 0.0
+
+    def call(self, kind: str, request: Any, fetch):
+        """ Replay the response to this request, or record what fetch() returns """
+        key = self.key(kind, request)
+        if self.mode == "record":
+            start = time.perf_counter()
+            response = fetch()
+            self._record(key, kind, response, time.perf_counter() - start)
+            return response
+        entry = self._lookup(key, kind)
+        time.sleep(self.simulated_latency(entry))
+        return entry["response"]
+
+    async def acall(self, kind: str, request: Any, afetch):
+        """ Async version of call, where afetch() returns an awaitable """
+        key = self.key(kind, request)
+        if self.mode == "record":
+            start = time.perf_counter()
+            response = await afetch()
+            self._record(key, kind, response, time.perf_counter() - start)
+            return response
+        entry = self._lookup(key, kind)
+        await asyncio.sleep(self.simulated_latency(entry))
+        return entry["response"]
+
+# Shared by every model and retriever in the studio graphs; disabled unless CASSETTE_MODE is set
+cassette = (
+    Cassette(os.getenv("CASSETTE_PATH", "cassette.jsonl"), os.environ["CASSETTE_MODE"], os.getenv("CASSETTE_LATENCY", "none"))
+    if os.getenv("CASSETTE_MODE") in ("record", "replay")
+    else None
+)
+
+def _message_request(message) -> dict:
+    # Message ids are random per run, so leave them out of the request hash
+    return {
+        "type": message.type,
+        "content": message.content,
+        "name": message.name,
+        "tool_calls": getattr(message, "tool_calls", None),
+        "tool_call_id": getattr(message, "tool_call_id", None),
+    }
+
+class CassetteChatModel(BaseChatModel):
+
+    """ Drop-in chat model that records the wrapped model's responses, or replays them without calling it """
+
+    model: BaseChatModel
+    cassette: Cassette
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    @property
+    def _llm_type(self) -> str:
+        return f"cassette-{self.model._llm_type}"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return self.model._identifying_params
+
+    def bind_tools(self, tools, **kwargs):
+        # Let the wrapped model format the tools, then pass the same kwargs through to it on each call
+        return self.bind(**self.model.bind_tools(tools, **kwargs).kwargs)
+
+    def _request(self, messages, stop: Optional[list], kwargs: dict) -> dict:
+        return {
+            "model": self.model._identifying_params,
+            "messages": [_message_request(message) for message in messages],
+            "stop": stop,
+            "kwargs": kwargs,
+        }
+
+    @staticmethod
+    def _result(response: list) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=message) for message in messages_from_dict(response)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        def fetch():
+            result = self.model._generate(messages, stop=stop, **kwargs)
+            return [message_to_dict(generation.message) for generation in result.generations]
+        return self._result(self.cassette.call("chat", self._request(messages, stop, kwargs), fetch))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        async def afetch():
+            result = await self.model._agenerate(messages, stop=stop, **kwargs)
+            return [message_to_dict(generation.message) for generation in result.generations]
+        return self._result(await self.cassette.acall("chat", self._request(messages, stop, kwargs), afetch))
+
+def use_cassette(model: BaseChatModel) -> BaseChatModel:
+    """ Wrap a chat model in the shared cassette when CASSETTE_MODE is set, otherwise return it unchanged """
+    return CassetteChatModel(model=model, cassette=cassette) if cassette is not None else model
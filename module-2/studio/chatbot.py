@@ -1,21 +1,87 @@
+import asyncio
+import contextvars
+import os
+from typing import Annotated
+
 from langchain_core.messages import HumanMessage, SystemMessage, RemoveMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from langgraph.graph import MessagesState
 from langgraph.graph import StateGraph, START, END
 
+from cassette import use_cassette
+
 # We will use this model for both the conversation and the summarization
 from langchain_openai import ChatOpenAI
-model = ChatOpenAI(model="gpt-4o", temperature=0) 
+model = use_cassette(ChatOpenAI(model="gpt-4o", temperature=0))
+
+# Summarize after the reply is returned, off the critical path, instead of before the turn ends
+background_summary = os.getenv("BACKGROUND_SUMMARY", "false").lower() == "true"
+
+# Background summaries that have not been committed to their thread yet, by thread_id
+pending_summaries = {}
+pending_summary_ttl_seconds = float(os.getenv("PENDING_SUMMARY_TTL_SECONDS", "3600"))
 
-# State class to store messages and summary
+# Token budgets: how much history is sent to the model, and how much history triggers a summary
+max_history_tokens = int(os.getenv("MAX_HISTORY_TOKENS", "8000"))
+summary_trigger_tokens = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "2000"))
+
+# merge_token_counts and trim_history are copied in the module-1, module-2 and module-3 studios; keep the copies identical
+def merge_token_counts(left: dict, right: dict) -> dict:
+    """Token counts by message id; a count of None drops the entry."""
+    merged = {**left, **right}
+    return {id: count for id, count in merged.items() if count is not None}
+
+# State class to store messages, summary, the id of the last message folded into the summary,
+# and the token count of each message
 class State(MessagesState):
     summary: str
+    summarized_through: str
+    token_counts: Annotated[dict, merge_token_counts]
+
+def count_new_tokens(state: State, messages: list) -> dict:
+
+    """Count only the messages that have no cached count yet."""
+
+    token_counts = state.get("token_counts", {})
+    return {m.id: count_tokens_approximately([m]) for m in messages if m.id not in token_counts}
+
+def history_tokens(messages: list, token_counts: dict) -> int:
+    return sum(token_counts.get(m.id, 0) for m in messages)
+
+def trim_history(messages: list, token_counts: dict, max_tokens: int) -> list:
+
+    """The most recent messages that fit in max_tokens, starting on a human message."""
+
+    kept, total = [], 0
+    for message in reversed(messages):
+        total += token_counts.get(message.id, 0)
+        if total > max_tokens:
+            break
+        kept.append(message)
+    kept.reverse()
+
+    # Start on a human message, so no tool result or reply is cut off from what it answers
+    while kept and not isinstance(kept[0], HumanMessage):
+        kept.pop(0)
+
+    # If even the latest exchange is over budget, keep it whole
+    if not kept:
+        last_human = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=0)
+        kept = messages[last_human:]
+    return kept
     
 # Define the logic to call the model
-def call_model(state: State):
+def model_input(state: State) -> tuple:
     
     # Get summary if it exists
     summary = state.get("summary", "")
 
+    # Count the new messages once, then send only the history that fits the budget
+    new_token_counts = count_new_tokens(state, state["messages"])
+    token_counts = {**state.get("token_counts", {}), **new_token_counts}
+    history = trim_history(state["messages"], token_counts, max_history_tokens)
+
     # If there is summary, then we add it to messages
     if summary:
         
@@ -23,13 +89,31 @@ def call_model(state: State):
         system_message = f"Summary of conversation earlier: {summary}"
 
         # Append summary to any newer messages
-        messages = [SystemMessage(content=system_message)] + state["messages"]
+        messages = [SystemMessage(content=system_message)] + history
     
     else:
-        messages = state["messages"]
+        messages = history
     
+    return messages, new_token_counts, token_counts
+
+def call_model(state: State):
+    messages, new_token_counts, _ = model_input(state)
     response = model.invoke(messages)
-    return {"messages": response}
+    new_token_counts[response.id] = count_tokens_approximately([response])
+    return {"messages": response, "token_counts": new_token_counts}
+
+async def acall_model(state: State, config: RunnableConfig):
+    messages, new_token_counts, token_counts = model_input(state)
+    response = await model.ainvoke(messages)
+    new_token_counts[response.id] = count_tokens_approximately([response])
+    token_counts[response.id] = new_token_counts[response.id]
+
+    # In background mode, start summarizing now and let the next turn commit the result
+    thread_id = config["configurable"].get("thread_id")
+    if background_summary and thread_id is not None and history_tokens(state["messages"] + [response], token_counts) > summary_trigger_tokens:
+        schedule_summary(thread_id, state["messages"] + [response], state.get("summary", ""), state.get("summarized_through"))
+
+    return {"messages": response, "token_counts": new_token_counts}
 
 # Determine whether to end or summarize the conversation
 def should_continue(state: State):
@@ -38,17 +122,23 @@ def should_continue(state: State):
     
     messages = state["messages"]
     
-    # If there are more than six messages, then we summarize the conversation
-    if len(messages) > 6:
+    # If the history is over the token budget, then we summarize the conversation
+    if history_tokens(messages, state["token_counts"]) > summary_trigger_tokens:
         return "summarize_conversation"
     
     # Otherwise we can just end
     return END
 
-def summarize_conversation(state: State):
-    
-    # First get the summary if it exists
-    summary = state.get("summary", "")
+def after_watermark(messages: list, summarized_through: str) -> list:
+
+    """Messages after the last one already folded into the summary."""
+
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i].id == summarized_through:
+            return messages[i + 1:]
+    return messages
+
+def summary_prompt(messages: list, summary: str, summarized_through: str) -> list:
 
     # Create our summarization prompt 
     if summary:
@@ -63,23 +153,91 @@ def summarize_conversation(state: State):
         # If no summary exists, just create a new one
         summary_message = "Create a summary of the conversation above:"
 
-    # Add prompt to our history
-    messages = state["messages"] + [HumanMessage(content=summary_message)]
-    response = model.invoke(messages)
+    # Add prompt to the messages not yet in the summary; the ones kept after earlier summaries are already in it
+    return after_watermark(messages, summarized_through) + [HumanMessage(content=summary_message)]
+
+def summary_update(messages: list, response) -> dict:
     
     # Delete all but the 2 most recent messages and add our summary to the state 
-    delete_messages = [RemoveMessage(id=m.id) for m in state["messages"][:-2]]
-    return {"summary": response.content, "messages": delete_messages}
+    delete_messages = [RemoveMessage(id=m.id) for m in messages[:-2]]
+    return {
+        "summary": response.content,
+        "summarized_through": messages[-1].id,
+        "messages": delete_messages,
+        "token_counts": {m.id: None for m in messages[:-2]},
+    }
+
+async def summarize(messages: list, summary: str, summarized_through: str = None) -> dict:
+    response = await model.ainvoke(summary_prompt(messages, summary, summarized_through))
+    return summary_update(messages, response)
+
+def summarize_conversation(state: State):
+
+    # First get the summary if it exists
+    summary = state.get("summary", "")
+    response = model.invoke(summary_prompt(state["messages"], summary, state.get("summarized_through")))
+    return summary_update(state["messages"], response)
+
+async def asummarize_conversation(state: State):
+    summary = state.get("summary", "")
+    return await summarize(state["messages"], summary, state.get("summarized_through"))
+
+def schedule_summary(thread_id: str, messages: list, summary: str, summarized_through: str):
+
+    """Summarize a thread in the background; the result waits in pending_summaries for the thread's next turn."""
+
+    # A fresh context, so the task is not traced as part of this (finished) run
+    task = asyncio.create_task(summarize(messages, summary, summarized_through), context=contextvars.Context())
+    pending_summaries[thread_id] = task
+
+    def expire():
+        if pending_summaries.get(thread_id) is task:
+            del pending_summaries[thread_id]
+
+    # Failed summaries are dropped right away; results for threads that do not come back are dropped after
+    # pending_summary_ttl_seconds. Either way call_model starts a new summary on the thread's next turn.
+    task.add_done_callback(
+        lambda done: asyncio.get_running_loop().call_later(
+            0 if done.cancelled() or done.exception() is not None else pending_summary_ttl_seconds, expire
+        )
+    )
+
+async def apply_summary(state: State, config: RunnableConfig):
+
+    """Commit the summary started in the background after the previous turn, before the model reads state."""
+
+    task = pending_summaries.pop(config["configurable"].get("thread_id"), None)
+
+    # Without a result (e.g. after a restart, or if summarizing failed) the thread stays as is,
+    # and call_model starts a new summary at the end of this turn
+    if task is None:
+        return {}
+    try:
+        return await task
+    except Exception:
+        return {}
 
 # Define a new graph
 workflow = StateGraph(State)
-workflow.add_node("conversation", call_model)
-workflow.add_node(summarize_conversation)
 
-# Set the entrypoint as conversation
-workflow.add_edge(START, "conversation")
-workflow.add_conditional_edges("conversation", should_continue)
-workflow.add_edge("summarize_conversation", END)
+if background_summary:
+    # Background summaries are asyncio tasks, so this mode runs with ainvoke / astream only
+    workflow.add_node("conversation", acall_model)
+
+    # Set the entrypoint as apply_summary, which commits the previous turn's summary
+    workflow.add_node(apply_summary)
+    workflow.add_edge(START, "apply_summary")
+    workflow.add_edge("apply_summary", "conversation")
+    workflow.add_edge("conversation", END)
+else:
+    # Both sync and async versions, so the graph runs with invoke as well as ainvoke
+    workflow.add_node("conversation", RunnableLambda(call_model, acall_model))
+    workflow.add_node("summarize_conversation", RunnableLambda(summarize_conversation, asummarize_conversation))
+
+    # Set the entrypoint as conversation
+    workflow.add_edge(START, "conversation")
+    workflow.add_conditional_edges("conversation", should_continue)
+    workflow.add_edge("summarize_conversation", END)
 
 # Compile
 graph = workflow.compile()
\ No newline at end of file
@@ -0,0 +1,48 @@
+import asyncio
+
+class MicroBatcher:
+
+    """ Collect items submitted within a short window and process them together with one run_batch call """
+
+    def __init__(self, run_batch, window_seconds: float = 0.05, max_batch_size: int = 20):
+        # run_batch is an async function from a list of items to a list of results in the same order
+        self.run_batch = run_batch
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._pending = []
+        self._timer = None
+        # The event loop only keeps weak references to tasks, so running batches are held here until they finish
+        self._tasks = set()
+
+    async def submit(self, item):
+        """ Queue one item and wait for its result """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_seconds, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list):
+        try:
+            results = await self.run_batch([item for item, _ in batch])
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,260 @@
+""" Benchmark how the module-4 fan-out graphs scale with the number of Send() branches.
+
+Each graph runs against a stub chat model and stub retrievers with configurable latency, so results measure
+graph overhead and achieved parallelism rather than provider speed. Results are written as JSON lines.
+For research_assistant_turns the size is the number of interview turns rather than a fan-out width.
+
+Usage: python benchmark.py --graphs map_reduce,research_assistant --sizes 3,30,300 --latency 0.05 --output bench.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from context_store import estimate_tokens
+
+# Guards the stub's counters, which are updated from worker threads for sync nodes
+_lock = threading.Lock()
+
+class StubChatModel(BaseChatModel):
+
+    """ Chat model that sleeps for a fixed latency and answers tool / structured-output calls with schema-shaped data """
+
+    latency: float = 0.05
+    list_size: int = 3
+    completion_words: int = 200
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def _list_size(self, messages) -> int:
+        # A prompt that numbers its items (e.g. one joke per subject) gets one array entry per item, so batched calls
+        # line up with what they were asked for; other arrays get list_size entries, the fan-out size of the run
+        numbered = re.findall(r"^\d+\. ", str(messages[-1].content), re.MULTILINE) if messages else []
+        return len(numbered) or self.list_size
+
+    def _fake(self, schema: dict, defs: dict, list_size: int):
+        if "$ref" in schema:
+            return self._fake(defs[schema["$ref"].split("/")[-1]], defs, list_size)
+        kind = schema.get("type")
+        if kind == "object":
+            return {name: self._fake(value, defs, list_size) for name, value in schema.get("properties", {}).items()}
+        if kind == "array":
+            return [self._fake(schema["items"], defs, list_size) for _ in range(list_size)]
+        if kind == "integer":
+            return 0
+        return "stub"
+
+    def _respond(self, messages, kwargs) -> ChatResult:
+        if kwargs.get("tools"):
+            function = kwargs["tools"][0]["function"]
+            args = self._fake(function["parameters"], function["parameters"].get("$defs", {}), self._list_size(messages))
+            message = AIMessage(content="", tool_calls=[{"name": function["name"], "args": args, "id": f"call_{self.calls}"}])
+            completion = json.dumps(args)
+        else:
+            message = AIMessage(content=" ".join(["stub"] * self.completion_words))
+            completion = message.content
+        with _lock:
+            self.calls += 1
+            self.prompt_tokens += sum(estimate_tokens(str(m.content)) for m in messages)
+            self.completion_tokens += estimate_tokens(completion)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _enter(self):
+        with _lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def _exit(self):
+        with _lock:
+            self.in_flight -= 1
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self._enter()
+        try:
+            time.sleep(self.latency)
+            return self._respond(messages, kwargs)
+        finally:
+            self._exit()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self._enter()
+        try:
+            await asyncio.sleep(self.latency)
+            return self._respond(messages, kwargs)
+        finally:
+            self._exit()
+
+class NodeTimings(BaseCallbackHandler):
+
+    """ Start and end time of every node run, to measure fan-out parallelism whether or not the nodes call the LLM """
+
+    # Called in the thread that runs the node, so the times are not skewed by callback scheduling
+    run_inline = True
+
+    def __init__(self):
+        self.parents = {}
+        self.node_runs = {}  # run id -> [start, end]
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        with _lock:
+            self.parents[run_id] = parent_run_id
+            # A node's own run is named after the node; runnables inside it inherit the metadata but not the name
+            if metadata and kwargs.get("name") == metadata.get("langgraph_node"):
+                self.node_runs[run_id] = [time.perf_counter(), None]
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        with _lock:
+            if run_id in self.node_runs:
+                self.node_runs[run_id][1] = time.perf_counter()
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.on_chain_end(None, run_id=run_id)
+
+    def leaf_intervals(self) -> list:
+        """ (start, end) of the node runs that contain no other node runs, e.g. not subgraph nodes """
+        containers = set()
+        for run_id in self.node_runs:
+            parent = self.parents.get(run_id)
+            while parent is not None and parent not in self.node_runs:
+                parent = self.parents.get(parent)
+            containers.add(parent)
+        return [(start, end) for run_id, (start, end) in self.node_runs.items() if run_id not in containers and end is not None]
+
+def max_overlap(intervals: list) -> int:
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    peak = current = 0
+    for _, change in events:
+        current += change
+        peak = max(peak, current)
+    return peak
+
+def stub_retrievers(module, latency: float):
+    """ Replace a graph module's retriever functions with stubs of the given latency """
+    web_docs = [{"url": f"https://example.com/{i}", "content": "stub web result " * 50} for i in range(3)]
+    wikipedia_docs = [{"page_content": "stub wikipedia page " * 200, "metadata": {"source": f"https://en.wikipedia.org/wiki/Stub_{i}"}} for i in range(2)]
+    if hasattr(module, "search_web_docs"):
+        module.search_web_docs = lambda query: time.sleep(latency) or web_docs
+        module.search_wikipedia_docs = lambda query: time.sleep(latency) or wikipedia_docs
+    if hasattr(module, "asearch_web_docs"):
+        async def asearch_web_docs(query):
+            await asyncio.sleep(latency)
+            return web_docs
+        async def asearch_wikipedia_docs(query):
+            await asyncio.sleep(latency)
+            return wikipedia_docs
+        module.asearch_web_docs = asearch_web_docs
+        module.asearch_wikipedia_docs = asearch_wikipedia_docs
+
+# Each case returns (graph, inputs) for a given fan-out size, with the module's model swapped for the stub
+
+def map_reduce_case(size, stub):
+    import map_reduce
+    map_reduce.model = stub
+    return map_reduce.graph, [{"topic": "animals"}]
+
+def parallelization_case(size, stub):
+    # Two fixed retriever branches per question, so fan out over `size` questions at once
+    import parallelization
+    parallelization.llm = stub
+    stub_retrievers(parallelization, stub.latency)
+    return parallelization.graph, [{"question": f"question {i}"} for i in range(size)]
+
+def sub_graphs_case(size, stub):
+    import sub_graphs
+    logs = [
+        {"id": str(i), "question": f"question {i}", "docs": None, "answer": "answer", **({"grade": 0, "grader": "stub", "feedback": "bad"} if i % 3 == 0 else {})}
+        for i in range(size)
+    ]
+    return sub_graphs.graph, [{"raw_logs": logs}]
+
+def research_assistant_case(size, stub):
+    import research_assistant
+    research_assistant.llm = stub
+    stub_retrievers(research_assistant, stub.latency)
+    # Compile without the human_feedback interrupt so the run goes straight through to the report
+    graph = research_assistant.builder.compile().with_config(max_concurrency=research_assistant.max_concurrent_interviews)
+    return graph, [{"topic": "benchmarks", "max_analysts": size}]
+
+def research_assistant_turns_case(size, stub):
+    # The report graph always runs two-turn interviews, so sweep turns on a single interview
+    import research_assistant
+    research_assistant.llm = stub
+    stub_retrievers(research_assistant, stub.latency)
+    analyst = research_assistant.Analyst(affiliation="stub", name="stub", role="stub", description="stub")
+    messages = [HumanMessage(content="So you said you were writing an article on benchmarks?")]
+    return research_assistant.interview_builder.compile(), [{"analyst": analyst, "messages": messages, "max_num_turns": size}]
+
+cases = {
+    "map_reduce": map_reduce_case,
+    "parallelization": parallelization_case,
+    "sub_graphs": sub_graphs_case,
+    "research_assistant": research_assistant_case,
+    "research_assistant_turns": research_assistant_turns_case,
+}
+
+async def run_case(name: str, size: int, latency: float) -> dict:
+    stub = StubChatModel(latency=latency, list_size=size)
+    graph, inputs = cases[name](size, stub)
+    timings = NodeTimings()
+    tracemalloc.start()
+    start = time.perf_counter()
+    await graph.abatch(inputs, {"recursion_limit": 10 * size + 1000, "callbacks": [timings]})
+    wall_time = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    nodes = timings.leaf_intervals()
+    return {
+        "graph": name,
+        "size": size,
+        "latency_s": latency,
+        "wall_time_s": round(wall_time, 4),
+        "llm_calls": stub.calls,
+        "max_parallel_llm_calls": stub.max_in_flight,
+        "max_parallel_nodes": max_overlap(nodes),
+        # Wall time if every node run had run one after another, divided by the actual wall time
+        "effective_parallelism": round(sum(end - start for start, end in nodes) / wall_time, 2) if wall_time else 0.0,
+        "prompt_tokens_est": stub.prompt_tokens,
+        "completion_tokens_est": stub.completion_tokens,
+        "peak_memory_bytes": peak_memory,
+    }
+
+async def main(args):
+    output = open(args.output, "a") if args.output else sys.stdout
+    for name in args.graphs.split(","):
+        for size in [int(size) for size in args.sizes.split(",")]:
+            result = await run_case(name, size, args.latency)
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    if args.output:
+        output.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the module-4 fan-out graphs against a stub LLM.")
+    parser.add_argument("--graphs", default=",".join(cases), help="Comma-separated graphs to run")
+    parser.add_argument("--sizes", default="3,30,300", help="Comma-separated fan-out sizes")
+    parser.add_argument("--latency", type=float, default=0.05, help="Stub LLM and retriever latency in seconds")
+    parser.add_argument("--output", help="Append JSON lines here instead of stdout")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,59 @@
+import math
+import re
+from collections import Counter
+
+from context_store import context_doc
+
+def tokenize(text: str) -> list:
+    return re.findall(r"\w+", text.lower())
+
+def split_passages(content: str, passage_words: int = 120) -> list:
+    """ Split a document into paragraphs, then into windows of at most passage_words words """
+    passages = []
+    for paragraph in re.split(r"\n\s*\n", content):
+        words = paragraph.split()
+        for start in range(0, len(words), passage_words):
+            passages.append(" ".join(words[start:start + passage_words]))
+    return passages
+
+def bm25_scores(query: str, passages: list, k1: float = 1.5, b: float = 0.75) -> list:
+    """ Score each passage against the query with Okapi BM25 """
+    tokenized = [tokenize(passage) for passage in passages]
+    if not tokenized:
+        return []
+    avg_len = sum(len(tokens) for tokens in tokenized) / len(tokenized) or 1.0
+    document_frequency = Counter(term for tokens in tokenized for term in set(tokens))
+    query_terms = set(tokenize(query))
+    scores = []
+    for tokens in tokenized:
+        term_frequency = Counter(tokens)
+        score = 0.0
+        for term in query_terms:
+            tf = term_frequency.get(term, 0)
+            if not tf:
+                continue
+            df = document_frequency[term]
+            idf = math.log(1 + (len(tokenized) - df + 0.5) / (df + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(tokens) / avg_len))
+        scores.append(score)
+    return scores
+
+def compress_context(context: list, query: str, max_passages: int = 8) -> list:
+    """ Keep only the max_passages passages most relevant to the query, under their original source tags """
+    passages = [
+        (doc_index, passage_index, passage)
+        for doc_index, doc in enumerate(context)
+        for passage_index, passage in enumerate(split_passages(doc["content"]))
+    ]
+    scores = bm25_scores(query, [passage for _, _, passage in passages])
+    ranked = sorted(range(len(passages)), key=lambda i: scores[i], reverse=True)[:max_passages]
+
+    # Re-assemble the winning passages per document, in reading order
+    kept = {}
+    for i in sorted(ranked, key=lambda i: passages[i][:2]):
+        doc_index, _, passage = passages[i]
+        kept.setdefault(doc_index, []).append(passage)
+    return [
+        context_doc(context[doc_index]["key"], context[doc_index]["header"], "\n...\n".join(kept[doc_index]))
+        for doc_index in sorted(kept)
+    ]
@@ -0,0 +1,31 @@
+def estimate_tokens(text: str) -> int:
+    """ Rough token count (~4 characters per token), cheap enough to run on every document """
+    return max(1, len(text) // 4)
+
+def context_doc(key: str, header: str, content: str) -> dict:
+    """ Wrap one <Document> for the context store, keyed by its URL or source """
+    document = f"{header}\n{content}\n</Document>"
+    return {"key": key, "header": header, "content": content, "document": document, "tokens": estimate_tokens(document)}
+
+def merge_context(left: list, right: list) -> list:
+    """ Reducer that appends new documents, skipping any whose key was already retrieved """
+    seen = {doc["key"] for doc in left}
+    merged = list(left)
+    for doc in right:
+        if doc["key"] not in seen:
+            seen.add(doc["key"])
+            merged.append(doc)
+    return merged
+
+def format_context(context: list, max_tokens: int) -> str:
+    """ Pack documents into a prompt string of at most max_tokens, preferring the most recent """
+    selected = []
+    used = 0
+    for i in range(len(context) - 1, -1, -1):
+        doc = context[i]
+        if used + doc["tokens"] > max_tokens:
+            continue
+        selected.append(i)
+        used += doc["tokens"]
+    # Restore retrieval order so sources read chronologically
+    return "\n\n---\n\n".join(context[i]["document"] for i in sorted(selected))
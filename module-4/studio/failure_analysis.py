@@ -0,0 +1,52 @@
+from typing import Union
+from typing_extensions import TypedDict
+from langgraph.graph import StateGraph, START, END
+
+from log_batch import LogBatch, ProcessedLogs
+from shared_refs import SharedRef, resolve
+
+# The failure analysis sub-graph of sub_graphs.py. It lives in its own module, imported by name and with no
+# import-time side effects (such as the metrics server), so the sharded mode's worker processes can load it
+# however sub_graphs.py was loaded (the LangGraph server loads graph files from a path) and with start
+# methods that do not fork, where workers import everything afresh.
+
+# Failure Analysis Sub-graph
+class FailureAnalysisState(TypedDict):
+    cleaned_logs: Union[LogBatch, SharedRef]
+    failures: LogBatch
+    fa_summary: str
+    processed_logs: ProcessedLogs
+
+class FailureAnalysisOutputState(TypedDict):
+    fa_summary: str
+    processed_logs: ProcessedLogs
+
+def get_failures(state):
+    """ Get logs that contain a failure """
+    cleaned_logs = resolve(state["cleaned_logs"])
+    failures = cleaned_logs.filter(cleaned_logs.has("grade"))
+    return {"failures": failures}
+
+def generate_summary(state):
+    """ Generate summary of failures """
+    failures = state["failures"]
+    # Add fxn: fa_summary = summarize(failures, previous=state.get("fa_summary"))
+    # When streaming, the previous chunk's fa_summary comes in with the state and is folded into the new one
+    fa_summary = "Poor quality retrieval of Chroma documentation."
+    return {"fa_summary": fa_summary, "processed_logs": ProcessedLogs.segment("failure-analysis-on-log-", failures.id)}
+
+fa_builder = StateGraph(input=FailureAnalysisState,output=FailureAnalysisOutputState)
+fa_builder.add_node("get_failures", get_failures)
+fa_builder.add_node("generate_summary", generate_summary)
+fa_builder.add_edge(START, "get_failures")
+fa_builder.add_edge("get_failures", "generate_summary")
+fa_builder.add_edge("generate_summary", END)
+
+fa_graph = fa_builder.compile()
+
+def analyze_shard(cleaned_logs, rows) -> dict:
+    """ Run the failure analysis sub-graph on rows [start, stop) of cleaned_logs, a LogBatch or a SharedRef to one; called in a worker process """
+    cleaned_logs = resolve(cleaned_logs)
+    if rows is not None:
+        cleaned_logs = cleaned_logs.take(range(*rows))
+    return fa_graph.invoke({"cleaned_logs": cleaned_logs})
@@ -0,0 +1,88 @@
+import asyncio
+import importlib.util
+import os
+import threading
+import weakref
+
+import httpx
+
+class ConnectionStats:
+
+    """ Counts requests and newly opened connections, so the pool's connection reuse rate can be exported """
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self._lock = threading.Lock()
+
+    def _event(self, event_name: str):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+
+    def trace(self, event_name: str, info: dict):
+        self._event(event_name)
+
+    async def atrace(self, event_name: str, info: dict):
+        self._event(event_name)
+
+    def on_request(self, request: httpx.Request):
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = self.trace
+
+    async def aon_request(self, request: httpx.Request):
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = self.atrace
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            reused = self.requests - self.new_connections
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reuse_rate": reused / self.requests if self.requests else 0.0,
+            }
+
+connection_stats = ConnectionStats()
+
+class LoopLocalAsyncClient(httpx.AsyncClient):
+
+    """ An AsyncClient that opens a separate pool for each event loop, since pooled connections belong to the loop that opened them """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._client_kwargs = kwargs
+        self._clients = weakref.WeakKeyDictionary()
+        self._clients_lock = threading.Lock()
+
+    def _loop_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._clients_lock:
+            client = self._clients.get(loop)
+            if client is None:
+                client = self._clients[loop] = httpx.AsyncClient(**self._client_kwargs)
+        return client
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        return await self._loop_client().send(request, **kwargs)
+
+    async def aclose(self):
+        with self._clients_lock:
+            client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+        await super().aclose()
+
+# One keep-alive pool per process, shared by the model providers and retrievers
+pool_size = int(os.getenv("HTTP_POOL_SIZE", "100"))
+limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=60)
+timeout = httpx.Timeout(60.0, connect=10.0)
+
+# HTTP/2 needs the optional h2 package (pip install "httpx[http2]")
+http2 = os.getenv("HTTP2", "true").lower() == "true" and importlib.util.find_spec("h2") is not None
+
+http_client = httpx.Client(limits=limits, timeout=timeout, http2=http2, event_hooks={"request": [connection_stats.on_request]})
+# Safe to share across asyncio.run calls: each loop gets its own pool on first use
+http_async_client = LoopLocalAsyncClient(limits=limits, timeout=timeout, http2=http2, event_hooks={"request": [connection_stats.aon_request]})
@@ -0,0 +1,277 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from http_clients import connection_stats
+from retrieval_cache import retrieval_cache
+
+logger = logging.getLogger(__name__)
+
+# USD per 1M tokens (input, output); models not listed are counted at zero cost
+model_prices = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+def estimate_cost(model_name: str, input_tokens: int, output_tokens: int) -> float:
+    # Match the longest listed prefix, so dated snapshots like gpt-4o-2024-08-06 share their base price
+    matches = [name for name in model_prices if model_name.startswith(name)]
+    if not matches:
+        return 0.0
+    input_price, output_price = model_prices[max(matches, key=len)]
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+def _span_id(run_id) -> str:
+    # Run ids are uuid7: the leading digits are a timestamp shared by concurrent runs, the tail is random
+    return run_id.hex[-16:]
+
+class GraphInstrumentation(BaseCallbackHandler):
+
+    """ Callback that records per-node wall time, start lag, LLM tokens and estimated cost for compiled graphs """
+
+    # Run callbacks on the calling thread / event loop so timestamps are taken when events happen
+    run_inline = True
+
+    def __init__(self, otlp_path: str = None, prometheus_port: int = None):
+        self.otlp_path = otlp_path
+        # The metrics server starts with the first graph run rather than at import, so processes that only
+        # import a graph module (pool workers, extra server workers) do not compete for the port
+        self.prometheus_port = prometheus_port
+        self._server = None
+        self._lock = threading.Lock()
+        self._runs = {}
+        self._parents = {}
+        self._llm_runs = {}
+        self._step_starts = {}
+        self._spans = defaultdict(list)
+        # Aggregates keyed by (graph, node)
+        self.wall_time = defaultdict(float)
+        self.start_lag = defaultdict(float)
+        self.node_runs = defaultdict(int)
+        self.input_tokens = defaultdict(int)
+        self.output_tokens = defaultdict(int)
+        self.cost = defaultdict(float)
+
+    @staticmethod
+    def _labels(metadata: dict) -> tuple:
+        # The checkpoint namespace names the task, so each Send() branch and subgraph run gets its own label
+        branch = metadata.get("langgraph_checkpoint_ns", "")
+        return metadata.get("graph", ""), metadata.get("langgraph_node", ""), branch
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        metadata = metadata or {}
+        now = time.time_ns()
+        with self._lock:
+            self._parents[run_id] = parent_run_id
+            if parent_run_id is None:
+                if self.prometheus_port is not None and self._server is None:
+                    self._start_server()
+                # Root graph run: the trace every node span belongs to
+                self._runs[run_id] = {"name": kwargs.get("name", "graph"), "graph": metadata.get("graph", ""), "start": now, "trace": run_id, "parent": None}
+                return
+            # Only the node's own run, not the runnables nested inside it
+            if kwargs.get("name") != metadata.get("langgraph_node"):
+                return
+            parent = self._tracked_ancestor(parent_run_id)
+            if parent is None:
+                return
+            graph, node, branch = self._labels(metadata)
+            trace = self._runs[parent]["trace"]
+            # How long after the first task of its step (in the same namespace) this task started. LangGraph does not
+            # report when tasks are scheduled, so this is the lag behind the step's first start, not the full queue wait
+            step_key = (branch.rpartition("|")[0], metadata.get("langgraph_step"))
+            step_start = self._step_starts.setdefault(trace, {}).setdefault(step_key, now)
+            self._runs[run_id] = {
+                "name": node, "graph": graph, "branch": branch, "step": metadata.get("langgraph_step"),
+                "start": now, "start_lag": (now - step_start) / 1e9, "trace": trace, "parent": parent,
+            }
+
+    def _tracked_ancestor(self, run_id):
+        # Walk past the runnables that wrap nodes to the closest node or root run
+        while run_id is not None and run_id not in self._runs:
+            run_id = self._parents.get(run_id)
+        return run_id
+
+    def _end(self, run_id, error: bool):
+        now = time.time_ns()
+        with self._lock:
+            self._parents.pop(run_id, None)
+            run = self._runs.pop(run_id, None)
+            if run is None:
+                return
+            run["end"] = now
+            run["error"] = error
+            self._spans[run["trace"]].append((run_id, run))
+            if run["parent"] is not None:
+                key = (run["graph"], run["name"])
+                self.wall_time[key] += (now - run["start"]) / 1e9
+                self.start_lag[key] += run["start_lag"]
+                self.node_runs[key] += 1
+                return
+            spans = self._spans.pop(run["trace"])
+            self._step_starts.pop(run["trace"], None)
+        if self.otlp_path:
+            self._export_trace(spans)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id, error=False)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, invocation_params=None, **kwargs):
+        metadata = metadata or {}
+        invocation_params = invocation_params or {}
+        model_name = invocation_params.get("model") or invocation_params.get("model_name") or metadata.get("ls_model_name", "")
+        with self._lock:
+            self._llm_runs[run_id] = (metadata.get("graph", ""), metadata.get("langgraph_node", ""), model_name)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            labels = self._llm_runs.pop(run_id, None)
+        if labels is None:
+            return
+        graph, node, model_name = labels
+        input_tokens = output_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                input_tokens += usage.get("input_tokens", 0)
+                output_tokens += usage.get("output_tokens", 0)
+        with self._lock:
+            self.input_tokens[(graph, node)] += input_tokens
+            self.output_tokens[(graph, node)] += output_tokens
+            self.cost[(graph, node)] += estimate_cost(model_name, input_tokens, output_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            self._llm_runs.pop(run_id, None)
+
+    def prometheus_text(self) -> str:
+        """ Aggregates in the Prometheus text exposition format. Branches are left out to keep label cardinality bounded. """
+        metrics = [
+            ("langgraph_node_wall_seconds_total", "counter", "Wall time spent in each node", self.wall_time),
+            ("langgraph_node_start_lag_seconds_total", "counter", "Time node tasks started after the first task of their step", self.start_lag),
+            ("langgraph_node_runs_total", "counter", "Number of node runs", self.node_runs),
+            ("langgraph_llm_input_tokens_total", "counter", "LLM input tokens used by each node", self.input_tokens),
+            ("langgraph_llm_output_tokens_total", "counter", "LLM output tokens used by each node", self.output_tokens),
+            ("langgraph_llm_cost_usd_total", "counter", "Estimated LLM cost of each node in USD", self.cost),
+        ]
+        lines = []
+        with self._lock:
+            for name, kind, help_text, values in metrics:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (graph, node), value in sorted(values.items()):
+                    lines.append(f'{name}{{graph="{graph}",node="{node}"}} {value}')
+        pool = connection_stats.snapshot()
+        for name, kind, help_text, value in [
+            ("http_pool_requests_total", "counter", "HTTP requests sent over the shared client pool", pool["requests"]),
+            ("http_pool_new_connections_total", "counter", "Connections opened by the shared client pool", pool["new_connections"]),
+            ("http_pool_reuse_ratio", "gauge", "Share of requests served on an already open connection", pool["reuse_rate"]),
+        ]:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        if retrieval_cache is not None:
+            cache = retrieval_cache.stats()
+            for name, kind, help_text, value in [
+                ("retrieval_cache_hits_total", "counter", "Retrieval cache lookups that found fresh docs", cache["hits"]),
+                ("retrieval_cache_misses_total", "counter", "Retrieval cache lookups that went to the retriever", cache["misses"]),
+                ("retrieval_cache_evictions_total", "counter", "Retrieval cache entries evicted to stay under the size limit", cache["evictions"]),
+                ("retrieval_cache_hit_ratio", "gauge", "Share of retrieval cache lookups that were hits", cache["hit_rate"]),
+            ]:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def _export_trace(self, spans: list):
+        # One OTLP/JSON ExportTraceServiceRequest per finished root run, one per line
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        otlp_spans = []
+        for run_id, run in spans:
+            attributes = [attribute("langgraph.graph", run["graph"])]
+            if run["parent"] is not None:
+                attributes += [
+                    attribute("langgraph.node", run["name"]),
+                    attribute("langgraph.branch", run["branch"]),
+                    attribute("langgraph.step", run["step"]),
+                    attribute("langgraph.start_lag_ms", round(run["start_lag"] * 1000)),
+                ]
+            span = {
+                "traceId": run["trace"].hex,
+                "spanId": _span_id(run_id),
+                "name": run["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(run["start"]),
+                "endTimeUnixNano": str(run["end"]),
+                "attributes": attributes,
+                "status": {"code": 2 if run["error"] else 1},
+            }
+            if run["parent"] is not None:
+                span["parentSpanId"] = _span_id(run["parent"])
+            otlp_spans.append(span)
+        request = {"resourceSpans": [{
+            "resource": {"attributes": [attribute("service.name", "langgraph-studio")]},
+            "scopeSpans": [{"scope": {"name": "instrumentation"}, "spans": otlp_spans}],
+        }]}
+        with self._lock, open(self.otlp_path, "a") as f:
+            f.write(json.dumps(request) + "\n")
+
+    def _start_server(self):
+        # Called with the lock held, so only the first root run starts it; a busy port is logged, not raised,
+        # as metrics must not take the graph down
+        self._server = False
+        try:
+            self._server = self.serve_prometheus(self.prometheus_port)
+        except OSError as error:
+            logger.warning("Prometheus metrics server not started on port %s: %s", self.prometheus_port, error)
+
+    def serve_prometheus(self, port: int) -> ThreadingHTTPServer:
+        """ Serve prometheus_text() at http://127.0.0.1:<port>/metrics from a daemon thread """
+        instrumentation = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = instrumentation.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+# Shared by every graph in the process; INSTRUMENTATION is a comma-separated list of "prometheus" and "otlp"
+_exporters = set(filter(None, os.getenv("INSTRUMENTATION", "").split(",")))
+instrumentation = (
+    GraphInstrumentation(
+        otlp_path=os.getenv("INSTRUMENTATION_OTLP_PATH", "traces.jsonl") if "otlp" in _exporters else None,
+        prometheus_port=int(os.getenv("INSTRUMENTATION_PORT", "9464")) if "prometheus" in _exporters else None,
+    )
+    if _exporters
+    else None
+)
+
+def instrument(graph, name: str):
+    """ Attach the shared instrumentation to a compiled graph, labelling its metrics with name """
+    if instrumentation is None:
+        return graph
+    return graph.with_config(callbacks=[instrumentation], metadata={"graph": name})
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from langchain_core.caches import BaseCache
+from langchain_core.language_models import BaseChatModel
+from langchain_core.load import dumps, loads
+from langchain_core.runnables.config import var_child_runnable_config
+
+def _strip_ids(value):
+    # Message ids are random per run, so they must not change the cache key
+    if isinstance(value, dict):
+        return {key: _strip_ids(item) for key, item in value.items() if key != "id" or not isinstance(item, str)}
+    if isinstance(value, list):
+        return [_strip_ids(item) for item in value]
+    return value
+
+class SQLiteLLMCache(BaseCache):
+
+    """ Exact-match cache of chat model responses in SQLite, evicting least recently used entries past max_bytes """
+
+    def __init__(self, path: str, max_bytes: int = 100 * 1024 * 1024, skip_nodes: tuple = ()):
+        self.path = path
+        self.max_bytes = max_bytes
+        # Graph nodes whose model calls always go to the provider
+        self.skip_nodes = set(skip_nodes)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, generations TEXT, size INTEGER, accessed_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_lru ON llm_cache (accessed_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(prompt: str, llm_string: str) -> str:
+        # llm_string carries the model name, temperature and any bound tools / structured-output schema
+        messages = json.dumps(_strip_ids(json.loads(prompt)), sort_keys=True)
+        return hashlib.sha256(f"{messages}\n{llm_string}".encode()).hexdigest()
+
+    def _skipped(self) -> bool:
+        config = var_child_runnable_config.get() or {}
+        return config.get("metadata", {}).get("langgraph_node") in self.skip_nodes
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[list]:
+        if self._skipped():
+            return None
+        key = self.key(prompt, llm_string)
+        with self._lock:
+            row = self._conn.execute("SELECT generations FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+        return [loads(generation) for generation in json.loads(row[0])]
+
+    def update(self, prompt: str, llm_string: str, return_val: list) -> None:
+        if self._skipped():
+            return
+        generations = json.dumps([dumps(generation) for generation in return_val])
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)",
+                (self.key(prompt, llm_string), generations, len(generations), time.time()),
+            )
+            # Evict least recently used entries until the store fits in max_bytes
+            (total,) = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+            while total > self.max_bytes:
+                row = self._conn.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at LIMIT 1").fetchone()
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (row[0],))
+                total -= row[1]
+            self._conn.commit()
+
+    def clear(self, **kwargs) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+# Shared by every model in the studio graphs; disabled unless LLM_CACHE_PATH is set
+llm_cache = (
+    SQLiteLLMCache(
+        os.environ["LLM_CACHE_PATH"],
+        max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", 100 * 1024 * 1024)),
+        skip_nodes=tuple(filter(None, os.getenv("LLM_CACHE_SKIP_NODES", "").split(","))),
+    )
+    if os.getenv("LLM_CACHE_PATH")
+    else None
+)
+
+def with_llm_cache(model: BaseChatModel) -> BaseChatModel:
+    """ Attach the shared cache to a chat model, only when it samples deterministically (temperature=0) """
+    if llm_cache is None or model._identifying_params.get("temperature") != 0:
+        return model
+    return model.model_copy(update={"cache": llm_cache})
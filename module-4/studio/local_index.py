@@ -0,0 +1,127 @@
+import json
+import math
+import mmap
+import os
+import sys
+from array import array
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from compression import tokenize
+
+# On-disk layout of an index directory. Everything except meta.json is memory-mapped on load.
+#   docs.bin / docs.idx          one JSON record per document, and byte offsets into docs.bin
+#   doclens.bin                  number of tokens in each document
+#   terms.bin / terms.idx        sorted vocabulary, and byte offsets into terms.bin
+#   postings.bin / postings.idx  (doc id, term frequency) pairs per term, and entry offsets into postings.bin
+
+def build_index(docs, path: str):
+    """ Build an inverted index over docs, an iterable of {"source", "title", "content"} dicts """
+    os.makedirs(path, exist_ok=True)
+    postings = defaultdict(list)
+    doc_offsets = array("Q", [0])
+    doc_lens = array("I")
+    with open(os.path.join(path, "docs.bin"), "wb") as f:
+        for doc_id, doc in enumerate(docs):
+            record = json.dumps({"source": doc["source"], "title": doc.get("title", ""), "content": doc["content"]}).encode()
+            f.write(record)
+            doc_offsets.append(doc_offsets[-1] + len(record))
+            tokens = tokenize(f'{doc.get("title", "")} {doc["content"]}')
+            doc_lens.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings[term].append((doc_id, tf))
+
+    term_offsets = array("Q", [0])
+    posting_offsets = array("Q", [0])
+    with open(os.path.join(path, "terms.bin"), "wb") as terms_file, open(os.path.join(path, "postings.bin"), "wb") as postings_file:
+        for term in sorted(postings):
+            encoded = term.encode()
+            terms_file.write(encoded)
+            term_offsets.append(term_offsets[-1] + len(encoded))
+            entries = array("I", [value for pair in postings[term] for value in pair])
+            entries.tofile(postings_file)
+            posting_offsets.append(posting_offsets[-1] + len(postings[term]))
+
+    for name, values in [("docs.idx", doc_offsets), ("doclens.bin", doc_lens), ("terms.idx", term_offsets), ("postings.idx", posting_offsets)]:
+        with open(os.path.join(path, name), "wb") as f:
+            values.tofile(f)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"num_docs": len(doc_lens), "avg_len": sum(doc_lens) / max(1, len(doc_lens))}, f)
+
+class LocalIndex:
+
+    """ Read-only BM25 search over an index built by build_index, served from memory-mapped files """
+
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75, max_df: float = 0.5):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.num_docs = meta["num_docs"]
+        self.avg_len = meta["avg_len"] or 1.0
+        self.k1 = k1
+        self.b = b
+        # Terms in more than this fraction of documents are skipped, as they score little and have the longest postings
+        self.max_df = max_df
+        self._maps = {}
+        self.docs = self._map(path, "docs.bin")
+        self.doc_offsets = self._map(path, "docs.idx").cast("Q")
+        self.doc_lens = np.frombuffer(self._map(path, "doclens.bin"), dtype=np.uint32)
+        self.terms = self._map(path, "terms.bin")
+        self.term_offsets = self._map(path, "terms.idx").cast("Q")
+        # (doc id, term frequency) rows, viewed in place over the mapping
+        self.postings = np.frombuffer(self._map(path, "postings.bin"), dtype=np.uint32).reshape(-1, 2)
+        self.posting_offsets = self._map(path, "postings.idx").cast("Q")
+        # BM25 length normalization of each document, the part of the score that does not depend on the query
+        self.doc_norms = self.k1 * (1 - self.b + self.b * self.doc_lens / self.avg_len)
+
+    def _map(self, path: str, name: str) -> memoryview:
+        with open(os.path.join(path, name), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")
+            self._maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._maps[name])
+
+    def _term_id(self, term: bytes):
+        # Binary search over the sorted vocabulary
+        lo, hi = 0, len(self.term_offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            candidate = self.terms[self.term_offsets[mid]:self.term_offsets[mid + 1]].tobytes()
+            if candidate < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.term_offsets) - 1 and self.terms[self.term_offsets[lo]:self.term_offsets[lo + 1]].tobytes() == term:
+            return lo
+        return None
+
+    def document(self, doc_id: int) -> dict:
+        return json.loads(self.docs[self.doc_offsets[doc_id]:self.doc_offsets[doc_id + 1]].tobytes())
+
+    def search(self, query: str, k: int = 3) -> list:
+        """ Return the k best matching documents as {"source", "title", "content"} dicts """
+        ranges = []
+        for term in set(tokenize(query)):
+            term_id = self._term_id(term.encode())
+            if term_id is not None:
+                ranges.append((self.posting_offsets[term_id], self.posting_offsets[term_id + 1]))
+        # Skip very common terms, unless the query has nothing else to match on
+        rare = [(start, end) for start, end in ranges if end - start <= self.max_df * self.num_docs]
+        scores = np.zeros(self.num_docs)
+        for start, end in rare or ranges:
+            idf = math.log(1 + (self.num_docs - (end - start) + 0.5) / (end - start + 0.5))
+            doc_ids, tf = self.postings[start:end, 0], self.postings[start:end, 1].astype(np.float64)
+            # Each document appears at most once in a term's postings, so plain fancy-index addition is safe
+            scores[doc_ids] += idf * tf * (self.k1 + 1) / (tf + self.doc_norms[doc_ids])
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        best = matched[np.argsort(-scores[matched], kind="stable")]
+        return [self.document(int(doc_id)) for doc_id in best]
+
+if __name__ == "__main__":
+    # Usage: python local_index.py corpus.jsonl index_dir
+    # Each corpus line is a JSON object with "source", "content" and optionally "title"
+    corpus_path, index_path = sys.argv[1], sys.argv[2]
+    with open(corpus_path) as corpus:
+        build_index((json.loads(line) for line in corpus if line.strip()), index_path)
@@ -0,0 +1,201 @@
+import itertools
+import json
+from dataclasses import dataclass
+
+import numpy as np
+
+@dataclass(frozen=True)
+class StringColumn:
+
+    """ Arrow-style string column: one UTF-8 buffer plus row offsets, with a validity mask for None values """
+
+    data: np.ndarray  # uint8
+    offsets: np.ndarray  # int64, len(column) + 1
+    valid: np.ndarray  # bool
+
+    @classmethod
+    def from_values(cls, values: list) -> "StringColumn":
+        encoded = [value.encode() if value is not None else b"" for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        valid = np.array([value is not None for value in values], dtype=bool)
+        return cls(data, offsets, valid)
+
+    def __len__(self) -> int:
+        return len(self.valid)
+
+    def take(self, rows: np.ndarray) -> "StringColumn":
+        """ Gather the given rows without decoding them """
+        starts, ends = self.offsets[rows], self.offsets[rows + 1]
+        lengths = ends - starts
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Byte positions of every gathered row, laid out back to back
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return StringColumn(self.data[positions], offsets, self.valid[rows])
+
+    def to_list(self) -> list:
+        buffer = self.data.tobytes()
+        bounds = self.offsets.tolist()
+        return [
+            buffer[start:end].decode() if valid else None
+            for start, end, valid in zip(bounds[:-1], bounds[1:], self.valid.tolist())
+        ]
+
+@dataclass(frozen=True)
+class LogBatch:
+
+    """ Columnar batch of Log records; `present` marks which rows carry each optional field """
+
+    id: StringColumn
+    question: StringColumn
+    answer: StringColumn
+    docs: StringColumn  # JSON-encoded, as docs are arbitrary lists
+    grade: np.ndarray  # int64, 0 where the row has no grade
+    grader: StringColumn
+    feedback: StringColumn
+    present: dict  # optional field name -> bool mask
+
+    optional_fields = ("docs", "grade", "grader", "feedback")
+
+    @classmethod
+    def from_logs(cls, logs: list) -> "LogBatch":
+        logs = list(logs)
+        present = {field: np.array([field in log for log in logs], dtype=bool) for field in cls.optional_fields}
+        return cls(
+            id=StringColumn.from_values([log["id"] for log in logs]),
+            question=StringColumn.from_values([log["question"] for log in logs]),
+            answer=StringColumn.from_values([log["answer"] for log in logs]),
+            docs=StringColumn.from_values([json.dumps(log["docs"]) if "docs" in log else None for log in logs]),
+            grade=np.array([log.get("grade") or 0 for log in logs], dtype=np.int64),
+            grader=StringColumn.from_values([log.get("grader") for log in logs]),
+            feedback=StringColumn.from_values([log.get("feedback") for log in logs]),
+            present=present,
+        )
+
+    def __len__(self) -> int:
+        return len(self.id)
+
+    def has(self, field: str) -> np.ndarray:
+        """ Mask of rows where an optional field is set, the columnar form of `field in log` """
+        return self.present[field]
+
+    def filter(self, mask: np.ndarray) -> "LogBatch":
+        return self.take(np.flatnonzero(mask))
+
+    def take(self, rows) -> "LogBatch":
+        rows = np.asarray(rows, dtype=np.int64)
+        return LogBatch(
+            id=self.id.take(rows),
+            question=self.question.take(rows),
+            answer=self.answer.take(rows),
+            docs=self.docs.take(rows),
+            grade=self.grade[rows],
+            grader=self.grader.take(rows),
+            feedback=self.feedback.take(rows),
+            present={field: rows_present[rows] for field, rows_present in self.present.items()},
+        )
+
+    def ids(self) -> list:
+        return self.id.to_list()
+
+    def to_logs(self) -> list:
+        """ Back to Log dicts, e.g. for code that still expects the row form """
+        columns = {
+            "id": self.id.to_list(),
+            "question": self.question.to_list(),
+            "answer": self.answer.to_list(),
+            "docs": [json.loads(docs) if docs is not None else None for docs in self.docs.to_list()],
+            "grade": self.grade.tolist(),
+            "grader": self.grader.to_list(),
+            "feedback": self.feedback.to_list(),
+        }
+        present = {field: mask.tolist() for field, mask in self.present.items()}
+        return [
+            {
+                field: values[row]
+                for field, values in columns.items()
+                if field not in present or present[field][row]
+            }
+            for row in range(len(self))
+        ]
+
+def _read_jsonl_chunk(path: str, cursor: int, chunk_size: int) -> tuple:
+    # The cursor is a byte offset, so each chunk seeks straight to where the last one stopped
+    logs = []
+    with open(path, "rb") as file:
+        file.seek(cursor)
+        while len(logs) < chunk_size and (line := file.readline()):
+            if line.strip():
+                logs.append(json.loads(line))
+        return logs, file.tell()
+
+def _read_parquet_chunk(path: str, cursor: int, chunk_size: int) -> tuple:
+    # The cursor is a row number; row groups before it are skipped using the file metadata only
+    # pyarrow is only needed for Parquet sources (pip install pyarrow)
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(path)
+    first_group, first_row = 0, 0
+    while first_group < parquet.num_row_groups and first_row + parquet.metadata.row_group(first_group).num_rows <= cursor:
+        first_row += parquet.metadata.row_group(first_group).num_rows
+        first_group += 1
+    rows = []
+    batches = parquet.iter_batches(batch_size=chunk_size, row_groups=range(first_group, parquet.num_row_groups))
+    for batch in batches:
+        rows.extend(batch.to_pylist())
+        if len(rows) >= cursor - first_row + chunk_size:
+            break
+    rows = rows[cursor - first_row:cursor - first_row + chunk_size]
+    # Parquet fills missing optional fields with nulls; drop them so `field in log` keeps its meaning
+    logs = [{field: value for field, value in row.items() if value is not None or field not in LogBatch.optional_fields} for row in rows]
+    return logs, cursor + len(logs)
+
+def read_log_chunk(source, cursor: int, chunk_size: int) -> tuple:
+    """ Read up to chunk_size logs from a .jsonl / .parquet path or an iterator of Log dicts.
+
+    Returns the chunk as a LogBatch and the cursor to resume from. Iterators are consumed in place,
+    so they only work in-process; use a file path when the graph runs with a checkpointer.
+    """
+    if isinstance(source, str) and source.endswith(".parquet"):
+        logs, cursor = _read_parquet_chunk(source, cursor, chunk_size)
+    elif isinstance(source, str):
+        logs, cursor = _read_jsonl_chunk(source, cursor, chunk_size)
+    else:
+        logs = list(itertools.islice(source, chunk_size))
+        cursor += len(logs)
+    return LogBatch.from_logs(logs), cursor
+
+@dataclass(frozen=True)
+class ProcessedLogs:
+
+    """ Append-only list of "<prefix><log id>" entries, stored as segments of (interned prefix, id column) """
+
+    prefixes: tuple = ()
+    segments: tuple = ()  # (index into prefixes, StringColumn of ids)
+
+    @classmethod
+    def segment(cls, prefix: str, ids: StringColumn) -> "ProcessedLogs":
+        return cls(prefixes=(prefix,), segments=((0, ids),))
+
+    def __len__(self) -> int:
+        return sum(len(ids) for _, ids in self.segments)
+
+    def __iter__(self):
+        for prefix, ids in self.segments:
+            yield from (f"{self.prefixes[prefix]}{id}" for id in ids.to_list())
+
+    def to_list(self) -> list:
+        return list(self)
+
+def append_processed_logs(left: ProcessedLogs, right: ProcessedLogs) -> ProcessedLogs:
+    """ Reducer for processed_logs: shares the existing segments and id columns, so the cost does not grow with the log count """
+    prefixes = list(left.prefixes)
+    remap = {}
+    for index, prefix in enumerate(right.prefixes):
+        if prefix not in prefixes:
+            prefixes.append(prefix)
+        remap[index] = prefixes.index(prefix)
+    segments = tuple(left.segments) + tuple((remap[prefix], ids) for prefix, ids in right.segments)
+    return ProcessedLogs(prefixes=tuple(prefixes), segments=segments)
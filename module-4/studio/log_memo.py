@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from log_batch import LogBatch
+
+class LogMemo:
+
+    """ Per-log results of earlier sub_graphs runs, keyed by Log.id and a hash of the log's content, plus the running summaries """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS logs (id TEXT PRIMARY KEY, hash TEXT, failure INTEGER)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS summaries (name TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    @staticmethod
+    def fingerprints(batch: LogBatch) -> list:
+        return [hashlib.sha256(json.dumps(log, sort_keys=True).encode()).hexdigest() for log in batch.to_logs()]
+
+    def lookup(self, batch: LogBatch) -> tuple:
+        """ Masks of the rows that are new or changed since they were recorded, and of the recorded failures """
+        ids, hashes = batch.ids(), self.fingerprints(batch)
+        known = {}
+        with self._lock:
+            # Stay under SQLite's limit on query parameters
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                known.update(
+                    (id, (hash, failure))
+                    for id, hash, failure in self._conn.execute(
+                        f"SELECT id, hash, failure FROM logs WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                    )
+                )
+        changed = np.array([known.get(id, (None,))[0] != hash for id, hash in zip(ids, hashes)], dtype=bool)
+        failures = np.array([bool(known.get(id, (None, 0))[1]) for id in ids], dtype=bool) & ~changed
+        return changed, failures
+
+    def record(self, batch: LogBatch, failures: LogBatch):
+        """ Remember the analyzed rows and which of them were failures """
+        failure_ids = set(failures.ids())
+        rows = [(id, hash, int(id in failure_ids)) for id, hash in zip(batch.ids(), self.fingerprints(batch))]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO logs VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def summaries(self) -> dict:
+        with self._lock:
+            return dict(self._conn.execute("SELECT name, value FROM summaries").fetchall())
+
+    def save_summaries(self, summaries: dict):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO summaries VALUES (?, ?)", summaries.items())
+            self._conn.commit()
+
+# Incremental mode for sub_graphs; disabled unless LOG_MEMO_PATH is set
+log_memo = LogMemo(os.environ["LOG_MEMO_PATH"]) if os.getenv("LOG_MEMO_PATH") else None
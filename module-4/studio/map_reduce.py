@@ -1,21 +1,49 @@
+import asyncio
 import operator
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Annotated
 from typing_extensions import TypedDict
 
 from pydantic import BaseModel
 
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import ChatOpenAI 
 
 from langgraph.constants import Send
 from langgraph.graph import END, StateGraph, START
 
+from batching import MicroBatcher
+from cassette import use_cassette
+from http_clients import http_async_client, http_client
+from instrumentation import instrument
+from llm_cache import with_llm_cache
+from scheduler import scheduled_model_kwargs, use_scheduler
+
 # Prompts we will use
 subjects_prompt = """Generate a list of 3 sub-topics that are all related to this overall topic: {topic}."""
 joke_prompt = """Generate a joke about {subject}"""
+batch_joke_prompt = """Generate one joke about each of these subjects. Return exactly one joke per subject, in the same order:\n\n{subjects}"""
 best_joke_prompt = """Below are a bunch of jokes about {topic}. Select the best one! Return the ID of the best one, starting 0 as the ID for the first joke. Jokes: \n\n  {jokes}"""
 
 # LLM
-model = ChatOpenAI(model="gpt-4o", temperature=0) 
+model = with_llm_cache(use_cassette(use_scheduler(ChatOpenAI(model="gpt-4o", temperature=0, http_client=http_client, http_async_client=http_async_client, **scheduled_model_kwargs))))
+
+# Opt-in: group generate_joke branches that arrive within a short window into one model call.
+# Batches are collected on the event loop, so only ainvoke / astream batch; invoke makes one call per joke.
+batch_jokes = os.getenv("BATCH_JOKES", "false").lower() == "true"
+joke_batch_window_seconds = float(os.getenv("JOKE_BATCH_WINDOW_SECONDS", "0.05"))
+max_joke_batch_size = int(os.getenv("MAX_JOKE_BATCH_SIZE", "20"))
+
+# Opt-in: pick the best joke in a tournament of groups this size, so no prompt holds more than this many jokes
+best_joke_group_size = int(os.getenv("BEST_JOKE_GROUP_SIZE", "0"))
+
+# Opt-in: "incremental" keeps a running best as jokes arrive instead of waiting for every branch,
+# finalizing early once a quorum (fraction of subjects) has arrived or the deadline has passed
+joke_reduce_mode = os.getenv("JOKE_REDUCE_MODE", "barrier")
+joke_reduce_quorum = float(os.getenv("JOKE_REDUCE_QUORUM", "1.0"))
+joke_reduce_deadline_seconds = float(os.getenv("JOKE_REDUCE_DEADLINE_SECONDS", "0"))
 
 # Define the state
 class Subjects(BaseModel):
@@ -46,11 +74,133 @@ def generate_joke(state: JokeState):
     response = model.with_structured_output(Joke).invoke(prompt)
     return {"jokes": [response.joke]}
 
+class Jokes(BaseModel):
+    jokes: list[str]
+
+async def generate_jokes_batch(subjects: list[str]) -> list[str]:
+    prompt = batch_joke_prompt.format(subjects="\n".join(f"{i}. {subject}" for i, subject in enumerate(subjects)))
+    response = await model.with_structured_output(Jokes).ainvoke(prompt)
+    if len(response.jokes) == len(subjects):
+        return response.jokes
+    # The model did not return one joke per subject, so fall back to a call per subject
+    prompts = [joke_prompt.format(subject=subject) for subject in subjects]
+    return [joke.joke for joke in await model.with_structured_output(Joke).abatch(prompts)]
+
+joke_batcher = MicroBatcher(generate_jokes_batch, joke_batch_window_seconds, max_joke_batch_size)
+
+async def generate_joke_batched(state: JokeState):
+    joke = await joke_batcher.submit(state["subject"])
+    return {"jokes": [joke]}
+
+def select_winners(topic: str, jokes: list, groups: list[list[int]]) -> list[int]:
+    """ Pick the best joke of each group of indices into jokes, judging all groups in parallel """
+    contested = [group for group in groups if len(group) > 1]
+    prompts = [best_joke_prompt.format(topic=topic, jokes="\n\n".join(jokes[i] for i in group)) for group in contested]
+    responses = iter(model.with_structured_output(BestJoke).batch(prompts))
+    # Map each group-local ID back to its index in jokes, keeping it in range
+    return [group[min(max(next(responses).id, 0), len(group) - 1)] if len(group) > 1 else group[0] for group in groups]
+
 def best_joke(state: OverallState):
-    jokes = "\n\n".join(state["jokes"])
-    prompt = best_joke_prompt.format(topic=state["topic"], jokes=jokes)
+    jokes = state["jokes"]
+    candidates = list(range(len(jokes)))
+
+    # Reduce in rounds of fixed-size groups until one group remains, so the depth is logarithmic
+    if best_joke_group_size > 1:
+        while len(candidates) > best_joke_group_size:
+            groups = [candidates[i:i + best_joke_group_size] for i in range(0, len(candidates), best_joke_group_size)]
+            candidates = select_winners(state["topic"], jokes, groups)
+
+    (winner,) = select_winners(state["topic"], jokes, [candidates])
+    return {"best_selected_joke": jokes[winner]}
+
+def generate_one_joke(subject: str) -> str:
+    response = model.with_structured_output(Joke).invoke(joke_prompt.format(subject=subject))
+    return response.joke
+
+async def agenerate_one_joke(subject: str) -> str:
+    if batch_jokes:
+        return await joke_batcher.submit(subject)
+    response = await model.with_structured_output(Joke).ainvoke(joke_prompt.format(subject=subject))
+    return response.joke
+
+def judge(topic: str, champion, arrivals: list[str]) -> str:
+    """ Compare the running best against the jokes that arrived since the last comparison """
+    candidates = ([champion] if champion is not None else []) + arrivals
+    if len(candidates) == 1:
+        return candidates[0]
+    prompt = best_joke_prompt.format(topic=topic, jokes="\n\n".join(candidates))
     response = model.with_structured_output(BestJoke).invoke(prompt)
-    return {"best_selected_joke": state["jokes"][response.id]}
+    return candidates[min(max(response.id, 0), len(candidates) - 1)]
+
+async def ajudge(topic: str, champion, arrivals: list[str]) -> str:
+    """ Async version of judge """
+    candidates = ([champion] if champion is not None else []) + arrivals
+    if len(candidates) == 1:
+        return candidates[0]
+    prompt = best_joke_prompt.format(topic=topic, jokes="\n\n".join(candidates))
+    response = await model.with_structured_output(BestJoke).ainvoke(prompt)
+    return candidates[min(max(response.id, 0), len(candidates) - 1)]
+
+def joke_quorum(subjects: list) -> int:
+    return max(1, min(len(subjects), round(joke_reduce_quorum * len(subjects))))
+
+# Under invoke, jokes are generated on this pool; stragglers cannot be interrupted there, so they finish in the background
+joke_pool = ThreadPoolExecutor()
+
+def generate_and_reduce_jokes(state: OverallState):
+
+    """ Generate every joke concurrently and reduce them as they complete, so stragglers do not hold up the result """
+
+    subjects = state["subjects"]
+    quorum = joke_quorum(subjects)
+    deadline = time.monotonic() + joke_reduce_deadline_seconds if joke_reduce_deadline_seconds > 0 else None
+
+    pending = {joke_pool.submit(generate_one_joke, subject) for subject in subjects}
+    jokes, champion = [], None
+    try:
+        while pending:
+            # Jokes that finish while we are judging are picked up together on the next pass
+            timeout = max(0.0, deadline - time.monotonic()) if deadline is not None and jokes else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            arrivals = [future.result() for future in done]
+            if arrivals:
+                jokes += arrivals
+                champion = judge(state["topic"], champion, arrivals)
+            if len(jokes) >= quorum or (deadline is not None and time.monotonic() >= deadline):
+                break
+    finally:
+        for future in pending:
+            future.cancel()
+
+    return {"jokes": jokes, "best_selected_joke": champion}
+
+async def agenerate_and_reduce_jokes(state: OverallState):
+
+    """ Async version of generate_and_reduce_jokes, where stragglers are cancelled """
+
+    subjects = state["subjects"]
+    quorum = joke_quorum(subjects)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + joke_reduce_deadline_seconds if joke_reduce_deadline_seconds > 0 else None
+
+    pending = {asyncio.ensure_future(agenerate_one_joke(subject)) for subject in subjects}
+    jokes, champion = [], None
+    try:
+        while pending:
+            timeout = max(0.0, deadline - loop.time()) if deadline is not None and jokes else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            arrivals = [task.result() for task in done]
+            if arrivals:
+                jokes += arrivals
+                champion = await ajudge(state["topic"], champion, arrivals)
+            if len(jokes) >= quorum or (deadline is not None and loop.time() >= deadline):
+                break
+    finally:
+        # Cancelled model calls give their scheduler slot back (see AdaptiveScheduler.arun)
+        for task in pending:
+            task.cancel()
+
+    return {"jokes": jokes, "best_selected_joke": champion}
 
 def continue_to_jokes(state: OverallState):
     return [Send("generate_joke", {"subject": s}) for s in state["subjects"]]
@@ -58,12 +208,18 @@ def continue_to_jokes(state: OverallState):
 # Construct the graph: here we put everything together to construct our graph
 graph_builder = StateGraph(OverallState)
 graph_builder.add_node("generate_topics", generate_topics)
-graph_builder.add_node("generate_joke", generate_joke)
-graph_builder.add_node("best_joke", best_joke)
 graph_builder.add_edge(START, "generate_topics")
-graph_builder.add_conditional_edges("generate_topics", continue_to_jokes, ["generate_joke"])
-graph_builder.add_edge("generate_joke", "best_joke")
-graph_builder.add_edge("best_joke", END)
+if joke_reduce_mode == "incremental":
+    # A graph step only ends when all of its branches do, so the streaming reduce lives inside a single node
+    graph_builder.add_node("generate_and_reduce_jokes", RunnableLambda(generate_and_reduce_jokes, agenerate_and_reduce_jokes))
+    graph_builder.add_edge("generate_topics", "generate_and_reduce_jokes")
+    graph_builder.add_edge("generate_and_reduce_jokes", END)
+else:
+    graph_builder.add_node("generate_joke", RunnableLambda(generate_joke, generate_joke_batched) if batch_jokes else generate_joke)
+    graph_builder.add_node("best_joke", best_joke)
+    graph_builder.add_conditional_edges("generate_topics", continue_to_jokes, ["generate_joke"])
+    graph_builder.add_edge("generate_joke", "best_joke")
+    graph_builder.add_edge("best_joke", END)
 
 # Compile the graph
-graph = graph_builder.compile()
+graph = instrument(graph_builder.compile(), "map_reduce")
@@ -1,63 +1,185 @@
+import asyncio
+import logging
 import operator
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Annotated
 from typing_extensions import TypedDict
 
 from langchain_core.documents import Document
 from langchain_core.messages import HumanMessage, SystemMessage
-
-from langchain_community.document_loaders import WikipediaLoader
-from langchain_community.tools.tavily_search import TavilySearchResults
+from langchain_core.runnables import RunnableLambda
 
 from langchain_openai import ChatOpenAI
 
 from langgraph.graph import StateGraph, START, END
 
-llm = ChatOpenAI(model="gpt-4o", temperature=0) 
+from cassette import use_cassette
+from http_clients import http_async_client, http_client
+from instrumentation import instrument
+from llm_cache import with_llm_cache
+from retrievers import asearch_web_docs, asearch_wikipedia_docs, local_web_docs, local_wikipedia_docs, search_web_docs, search_wikipedia_docs
+from scheduler import scheduled_model_kwargs, use_scheduler
+
+logger = logging.getLogger(__name__)
+
+llm = with_llm_cache(use_cassette(use_scheduler(ChatOpenAI(model="gpt-4o", temperature=0, http_client=http_client, http_async_client=http_async_client, **scheduled_model_kwargs))))
+
+# Per-retriever deadlines in seconds (0 means wait as long as it takes). A source that misses its
+# deadline is skipped and generate_answer goes ahead with whatever context has arrived.
+retrieval_deadline_seconds = {
+    "web": float(os.getenv("WEB_SEARCH_DEADLINE_SECONDS", "0")),
+    "wikipedia": float(os.getenv("WIKIPEDIA_DEADLINE_SECONDS", "0")),
+}
+
+# Opt-in hedging: if a source has not answered after this many seconds, also query the prebuilt local index
+# (see local_index.py) and take whichever answers first. 0 disables it.
+hedge_after_seconds = float(os.getenv("HEDGE_AFTER_SECONDS", "0"))
 
 class State(TypedDict):
     question: str
     answer: str
     context: Annotated[list, operator.add]
+    skipped_sources: Annotated[list, operator.add]
+
+def format_web_docs(search_docs: list) -> str:
+    return "\n\n---\n\n".join(
+        [
+            f'<Document href="{doc["url"]}"/>\n{doc["content"]}\n</Document>'
+            for doc in search_docs
+        ]
+    )
+
+def format_wikipedia_docs(search_docs: list) -> str:
+    return "\n\n---\n\n".join(
+        [
+            f'<Document source="{doc["metadata"]["source"]}" page="{doc["metadata"].get("page", "")}"/>\n{doc["page_content"]}\n</Document>'
+            for doc in search_docs
+        ]
+    )
+
+async def aretrieve_within_deadline(source: str, fetch, fallback):
+    """ Await fetch(), hedged with fallback(), and return None if neither answers by the source's deadline """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + retrieval_deadline_seconds[source] if retrieval_deadline_seconds[source] > 0 else None
+    pending = {asyncio.ensure_future(fetch())}
+    hedged = hedge_after_seconds <= 0
+    try:
+        while pending:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            if not hedged:
+                timeout = hedge_after_seconds if timeout is None else min(timeout, hedge_after_seconds)
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                logger.warning("%s retrieval failed", source, exc_info=task.exception())
+            if deadline is not None and loop.time() >= deadline:
+                return None
+            if not hedged and (not done or not pending):
+                # The primary is slow (or failed), so fire the duplicate request at the fallback
+                hedged = True
+                pending.add(asyncio.ensure_future(fallback()))
+    finally:
+        for task in pending:
+            task.cancel()
+    # Every request failed: skip the source, as if it had missed its deadline
+    return None
+
+# Sync searches run in threads, so they can be abandoned at the deadline like the async ones
+retrieval_pool = ThreadPoolExecutor()
+
+def retrieve_within_deadline(source: str, fetch, fallback):
+    """ Sync version of aretrieve_within_deadline, for graph.invoke """
+    deadline = time.monotonic() + retrieval_deadline_seconds[source] if retrieval_deadline_seconds[source] > 0 else None
+    pending = {retrieval_pool.submit(fetch)}
+    hedged = hedge_after_seconds <= 0
+    try:
+        while pending:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not hedged:
+                timeout = hedge_after_seconds if timeout is None else min(timeout, hedge_after_seconds)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                logger.warning("%s retrieval failed", source, exc_info=future.exception())
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            if not hedged and (not done or not pending):
+                hedged = True
+                pending.add(retrieval_pool.submit(fallback))
+    finally:
+        for future in pending:
+            future.cancel()
+    return None
 
 def search_web(state):
     
     """ Retrieve docs from web search """
 
-    # Search
-    tavily_search = TavilySearchResults(max_results=3)
-    search_docs = tavily_search.invoke(state['question'])
+    # Search, within the web search deadline
+    search_docs = retrieve_within_deadline(
+        "web",
+        lambda: search_web_docs(state['question']),
+        lambda: local_web_docs(state['question']),
+    )
+    if search_docs is None:
+        return {"skipped_sources": ["web"]}
 
      # Format
-    formatted_search_docs = "\n\n---\n\n".join(
-        [
-            f'<Document href="{doc["url"]}"/>\n{doc["content"]}\n</Document>'
-            for doc in search_docs
-        ]
+    return {"context": [format_web_docs(search_docs)]} 
+
+async def asearch_web(state):
+    
+    """ Retrieve docs from web search """
+
+    # Search, within the web search deadline
+    search_docs = await aretrieve_within_deadline(
+        "web",
+        lambda: asearch_web_docs(state['question']),
+        lambda: asyncio.to_thread(local_web_docs, state['question']),
     )
+    if search_docs is None:
+        return {"skipped_sources": ["web"]}
 
-    return {"context": [formatted_search_docs]} 
+     # Format
+    return {"context": [format_web_docs(search_docs)]} 
 
 def search_wikipedia(state):
     
     """ Retrieve docs from wikipedia """
 
-    # Search
-    search_docs = WikipediaLoader(query=state['question'], 
-                                  load_max_docs=2).load()
+    # Search, within the wikipedia deadline
+    search_docs = retrieve_within_deadline(
+        "wikipedia",
+        lambda: search_wikipedia_docs(state['question']),
+        lambda: local_wikipedia_docs(state['question']),
+    )
+    if search_docs is None:
+        return {"skipped_sources": ["wikipedia"]}
 
      # Format
-    formatted_search_docs = "\n\n---\n\n".join(
-        [
-            f'<Document source="{doc.metadata["source"]}" page="{doc.metadata.get("page", "")}"/>\n{doc.page_content}\n</Document>'
-            for doc in search_docs
-        ]
+    return {"context": [format_wikipedia_docs(search_docs)]} 
+
+async def asearch_wikipedia(state):
+    
+    """ Retrieve docs from wikipedia """
+
+    # Search, within the wikipedia deadline
+    search_docs = await aretrieve_within_deadline(
+        "wikipedia",
+        lambda: asearch_wikipedia_docs(state['question']),
+        lambda: asyncio.to_thread(local_wikipedia_docs, state['question']),
     )
+    if search_docs is None:
+        return {"skipped_sources": ["wikipedia"]}
 
-    return {"context": [formatted_search_docs]} 
+     # Format
+    return {"context": [format_wikipedia_docs(search_docs)]} 
 
-def generate_answer(state):
-    
-    """ Node to answer a question """
+def answer_messages(state) -> list:
 
     # Get state
     context = state["context"]
@@ -68,8 +190,24 @@ def generate_answer(state):
     answer_instructions = answer_template.format(question=question, 
                                                        context=context)    
     
+    return [SystemMessage(content=answer_instructions)]+[HumanMessage(content=f"Answer the question.")]
+
+def generate_answer(state):
+    
+    """ Node to answer a question """
+
+    # Answer
+    answer = llm.invoke(answer_messages(state))
+      
+    # Append it to state
+    return {"answer": answer}
+
+async def agenerate_answer(state):
+    
+    """ Node to answer a question """
+
     # Answer
-    answer = llm.invoke([SystemMessage(content=answer_instructions)]+[HumanMessage(content=f"Answer the question.")])
+    answer = await llm.ainvoke(answer_messages(state))
       
     # Append it to state
     return {"answer": answer}
@@ -78,9 +216,10 @@ def generate_answer(state):
 builder = StateGraph(State)
 
 # Initialize each node with node_secret 
-builder.add_node("search_web",search_web)
-builder.add_node("search_wikipedia", search_wikipedia)
-builder.add_node("generate_answer", generate_answer)
+# Each node has a sync and an async version, so the graph runs with invoke as well as ainvoke
+builder.add_node("search_web", RunnableLambda(search_web, asearch_web))
+builder.add_node("search_wikipedia", RunnableLambda(search_wikipedia, asearch_wikipedia))
+builder.add_node("generate_answer", RunnableLambda(generate_answer, agenerate_answer))
 
 # Flow
 builder.add_edge(START, "search_wikipedia")
@@ -88,4 +227,4 @@ builder.add_edge(START, "search_web")
 builder.add_edge("search_wikipedia", "generate_answer")
 builder.add_edge("search_web", "generate_answer")
 builder.add_edge("generate_answer", END)
-graph = builder.compile()
+graph = instrument(builder.compile(), "parallelization")
@@ -1,19 +1,37 @@
 import operator
+import os
 from pydantic import BaseModel, Field
 from typing import Annotated, List
 from typing_extensions import TypedDict
 
-from langchain_community.document_loaders import WikipediaLoader
-from langchain_community.tools.tavily_search import TavilySearchResults
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, get_buffer_string
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import ChatOpenAI
 
 from langgraph.constants import Send
 from langgraph.graph import END, MessagesState, START, StateGraph
 
+from cassette import use_cassette
+from http_clients import http_async_client, http_client
+from compression import compress_context
+from context_store import context_doc, format_context, merge_context
+from instrumentation import instrument
+from llm_cache import with_llm_cache
+from retrievers import asearch_web_docs, asearch_wikipedia_docs, search_web_docs, search_wikipedia_docs
+from scheduler import scheduled_model_kwargs, use_scheduler
+
 ### LLM
 
-llm = ChatOpenAI(model="gpt-4o", temperature=0) 
+llm = with_llm_cache(use_cassette(use_scheduler(ChatOpenAI(model="gpt-4o", temperature=0, http_client=http_client, http_async_client=http_async_client, **scheduled_model_kwargs))))
+
+# Cap on how many interviews run at once when the Send() API fans out over analysts
+max_concurrent_interviews = int(os.getenv("MAX_CONCURRENT_INTERVIEWS", "10"))
+
+# Token budget for the source documents packed into answer and section prompts
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+
+# Number of BM25-ranked passages kept from the source documents before prompting
+max_context_passages = int(os.getenv("MAX_CONTEXT_PASSAGES", "8"))
 
 ### Schema 
 
@@ -47,8 +65,9 @@ class GenerateAnalystsState(TypedDict):
 
 class InterviewState(MessagesState):
     max_num_turns: int # Number turns of conversation
-    context: Annotated[list, operator.add] # Source docs
+    context: Annotated[list, merge_context] # Source docs, deduplicated by URL or source
     analyst: Analyst # Analyst asking questions
+    search_query: str # Query shared by all retrievers this turn
     interview: str # Interview transcript
     sections: list # Final key we duplicate in outer state for Send() API
 
@@ -83,28 +102,41 @@ analyst_instructions="""You are tasked with creating a set of AI analyst persona
 
 5. Assign one analyst to each theme."""
 
-def create_analysts(state: GenerateAnalystsState):
-    
-    """ Create analysts """
+def analyst_messages(state: GenerateAnalystsState) -> list:
     
     topic=state['topic']
     max_analysts=state['max_analysts']
     human_analyst_feedback=state.get('human_analyst_feedback', '')
         
-    # Enforce structured output
-    structured_llm = llm.with_structured_output(Perspectives)
-
     # System message
     system_message = analyst_instructions.format(topic=topic,
                                                             human_analyst_feedback=human_analyst_feedback, 
                                                             max_analysts=max_analysts)
 
+    return [SystemMessage(content=system_message)]+[HumanMessage(content="Generate the set of analysts.")]
+
+# Each LLM and retriever node has a sync and an async version, so the graph runs with invoke as well as ainvoke
+
+def create_analysts(state: GenerateAnalystsState):
+    
+    """ Create analysts """
+    
+    # Enforce structured output
+    structured_llm = llm.with_structured_output(Perspectives)
+
     # Generate question 
-    analysts = structured_llm.invoke([SystemMessage(content=system_message)]+[HumanMessage(content="Generate the set of analysts.")])
+    analysts = structured_llm.invoke(analyst_messages(state))
     
     # Write the list of analysis to state
     return {"analysts": analysts.analysts}
 
+async def acreate_analysts(state: GenerateAnalystsState):
+    
+    """ Create analysts """
+    
+    analysts = await llm.with_structured_output(Perspectives).ainvoke(analyst_messages(state))
+    return {"analysts": analysts.analysts}
+
 def human_feedback(state: GenerateAnalystsState):
     """ No-op node that should be interrupted on """
     pass
@@ -128,9 +160,7 @@ When you are satisfied with your understanding, complete the interview with: "Th
 
 Remember to stay in character throughout your response, reflecting the persona and goals provided to you."""
 
-def generate_question(state: InterviewState):
-
-    """ Node to generate a question """
+def question_messages(state: InterviewState) -> list:
 
     # Get state
     analyst = state["analyst"]
@@ -138,11 +168,24 @@ def generate_question(state: InterviewState):
 
     # Generate question 
     system_message = question_instructions.format(goals=analyst.persona)
-    question = llm.invoke([SystemMessage(content=system_message)]+messages)
+    return [SystemMessage(content=system_message)]+messages
+
+def generate_question(state: InterviewState):
+
+    """ Node to generate a question """
+
+    question = llm.invoke(question_messages(state))
         
     # Write messages to state
     return {"messages": [question]}
 
+async def agenerate_question(state: InterviewState):
+
+    """ Node to generate a question """
+
+    question = await llm.ainvoke(question_messages(state))
+    return {"messages": [question]}
+
 # Search query writing
 search_instructions = SystemMessage(content=f"""You will be given a conversation between an analyst and an expert. 
 
@@ -154,51 +197,78 @@ Pay particular attention to the final question posed by the analyst.
 
 Convert this final question into a well-structured web search query""")
 
-def search_web(state: InterviewState):
-    
-    """ Retrieve docs from web search """
+def generate_search_query(state: InterviewState):
 
-    # Search
-    tavily_search = TavilySearchResults(max_results=3)
+    """ Node to write one search query that every retriever uses this turn """
 
     # Search query
     structured_llm = llm.with_structured_output(SearchQuery)
     search_query = structured_llm.invoke([search_instructions]+state['messages'])
+
+    return {"search_query": search_query.search_query}
+
+async def agenerate_search_query(state: InterviewState):
+
+    """ Node to write one search query that every retriever uses this turn """
+
+    search_query = await llm.with_structured_output(SearchQuery).ainvoke([search_instructions]+state['messages'])
+    return {"search_query": search_query.search_query}
+
+def web_context(search_docs: list) -> list:
+    return [
+        context_doc(doc["url"], f'<Document href="{doc["url"]}"/>', doc["content"])
+        for doc in search_docs
+    ]
+
+def search_web(state: InterviewState):
     
+    """ Retrieve docs from web search """
+
+    # Search query
+    search_query = state["search_query"]
+
     # Search
-    search_docs = tavily_search.invoke(search_query.search_query)
+    search_docs = search_web_docs(search_query)
 
      # Format
-    formatted_search_docs = "\n\n---\n\n".join(
-        [
-            f'<Document href="{doc["url"]}"/>\n{doc["content"]}\n</Document>'
-            for doc in search_docs
-        ]
-    )
+    return {"context": web_context(search_docs)} 
+
+async def asearch_web(state: InterviewState):
+    
+    """ Retrieve docs from web search """
+
+    search_docs = await asearch_web_docs(state["search_query"])
+    return {"context": web_context(search_docs)} 
 
-    return {"context": [formatted_search_docs]} 
+def wikipedia_context(search_docs: list) -> list:
+    return [
+        context_doc(
+            f'{doc["metadata"]["source"]}#{doc["metadata"].get("page", "")}',
+            f'<Document source="{doc["metadata"]["source"]}" page="{doc["metadata"].get("page", "")}"/>',
+            doc["page_content"],
+        )
+        for doc in search_docs
+    ]
 
 def search_wikipedia(state: InterviewState):
     
     """ Retrieve docs from wikipedia """
 
     # Search query
-    structured_llm = llm.with_structured_output(SearchQuery)
-    search_query = structured_llm.invoke([search_instructions]+state['messages'])
+    search_query = state["search_query"]
     
     # Search
-    search_docs = WikipediaLoader(query=search_query.search_query, 
-                                  load_max_docs=2).load()
+    search_docs = search_wikipedia_docs(search_query)
 
      # Format
-    formatted_search_docs = "\n\n---\n\n".join(
-        [
-            f'<Document source="{doc.metadata["source"]}" page="{doc.metadata.get("page", "")}"/>\n{doc.page_content}\n</Document>'
-            for doc in search_docs
-        ]
-    )
+    return {"context": wikipedia_context(search_docs)} 
+
+async def asearch_wikipedia(state: InterviewState):
+    
+    """ Retrieve docs from wikipedia """
 
-    return {"context": [formatted_search_docs]} 
+    search_docs = await asearch_wikipedia_docs(state["search_query"])
+    return {"context": wikipedia_context(search_docs)} 
 
 # Generate expert answer
 answer_instructions = """You are an expert being interviewed by an analyst.
@@ -229,18 +299,25 @@ When answering questions, follow these guidelines:
         
 And skip the addition of the brackets as well as the Document source preamble in your citation."""
 
-def generate_answer(state: InterviewState):
-    
-    """ Node to answer a question """
+def answer_messages(state: InterviewState) -> list:
 
     # Get state
     analyst = state["analyst"]
     messages = state["messages"]
-    context = state["context"]
 
-    # Answer question
+    # Keep only the passages relevant to the analyst's focus and latest question
+    query = f"{analyst.description}\n{messages[-1].content}"
+    context = format_context(compress_context(state["context"], query, max_context_passages), context_token_budget)
+
     system_message = answer_instructions.format(goals=analyst.persona, context=context)
-    answer = llm.invoke([SystemMessage(content=system_message)]+messages)
+    return [SystemMessage(content=system_message)]+messages
+
+def generate_answer(state: InterviewState):
+    
+    """ Node to answer a question """
+
+    # Answer question
+    answer = llm.invoke(answer_messages(state))
             
     # Name the message as coming from the expert
     answer.name = "expert"
@@ -248,6 +325,14 @@ def generate_answer(state: InterviewState):
     # Append it to state
     return {"messages": [answer]}
 
+async def agenerate_answer(state: InterviewState):
+    
+    """ Node to answer a question """
+
+    answer = await llm.ainvoke(answer_messages(state))
+    answer.name = "expert"
+    return {"messages": [answer]}
+
 def save_interview(state: InterviewState):
     
     """ Save interviews """
@@ -339,35 +424,51 @@ There should be no redundant sources. It should simply be:
 - Include no preamble before the title of the report
 - Check that all guidelines have been followed"""
 
-def write_section(state: InterviewState):
-
-    """ Node to write a section """
+def section_messages(state: InterviewState) -> list:
 
     # Get state
     interview = state["interview"]
-    context = state["context"]
     analyst = state["analyst"]
+
+    # Keep only the passages relevant to the analyst's focus
+    context = format_context(compress_context(state["context"], analyst.description, max_context_passages), context_token_budget)
    
     # Write section using either the gathered source docs from interview (context) or the interview itself (interview)
     system_message = section_writer_instructions.format(focus=analyst.description)
-    section = llm.invoke([SystemMessage(content=system_message)]+[HumanMessage(content=f"Use this source to write your section: {context}")]) 
+    return [SystemMessage(content=system_message)]+[HumanMessage(content=f"Use this source to write your section: {context}")]
+
+def write_section(state: InterviewState):
+
+    """ Node to write a section """
+
+    section = llm.invoke(section_messages(state)) 
                 
     # Append it to state
     return {"sections": [section.content]}
 
+async def awrite_section(state: InterviewState):
+
+    """ Node to write a section """
+
+    section = await llm.ainvoke(section_messages(state)) 
+    return {"sections": [section.content]}
+
 # Add nodes and edges 
 interview_builder = StateGraph(InterviewState)
-interview_builder.add_node("ask_question", generate_question)
-interview_builder.add_node("search_web", search_web)
-interview_builder.add_node("search_wikipedia", search_wikipedia)
-interview_builder.add_node("answer_question", generate_answer)
+interview_builder.add_node("ask_question", RunnableLambda(generate_question, agenerate_question))
+interview_builder.add_node("generate_search_query", RunnableLambda(generate_search_query, agenerate_search_query))
+interview_builder.add_node("search_web", RunnableLambda(search_web, asearch_web))
+interview_builder.add_node("search_wikipedia", RunnableLambda(search_wikipedia, asearch_wikipedia))
+interview_builder.add_node("answer_question", RunnableLambda(generate_answer, agenerate_answer))
 interview_builder.add_node("save_interview", save_interview)
-interview_builder.add_node("write_section", write_section)
+interview_builder.add_node("write_section", RunnableLambda(write_section, awrite_section))
 
 # Flow
 interview_builder.add_edge(START, "ask_question")
-interview_builder.add_edge("ask_question", "search_web")
-interview_builder.add_edge("ask_question", "search_wikipedia")
+interview_builder.add_edge("ask_question", "generate_search_query")
+# Every retriever reads the same query, so adding one is just another edge from generate_search_query
+interview_builder.add_edge("generate_search_query", "search_web")
+interview_builder.add_edge("generate_search_query", "search_wikipedia")
 interview_builder.add_edge("search_web", "answer_question")
 interview_builder.add_edge("search_wikipedia", "answer_question")
 interview_builder.add_conditional_edges("answer_question", route_messages,['ask_question','save_interview'])
@@ -428,9 +529,7 @@ Here are the memos from your analysts to build your report from:
 
 {context}"""
 
-def write_report(state: ResearchGraphState):
-
-    """ Node to write the final report body """
+def report_messages(state: ResearchGraphState) -> list:
 
     # Full set of sections
     sections = state["sections"]
@@ -441,7 +540,20 @@ def write_report(state: ResearchGraphState):
     
     # Summarize the sections into a final report
     system_message = report_writer_instructions.format(topic=topic, context=formatted_str_sections)    
-    report = llm.invoke([SystemMessage(content=system_message)]+[HumanMessage(content=f"Write a report based upon these memos.")]) 
+    return [SystemMessage(content=system_message)]+[HumanMessage(content=f"Write a report based upon these memos.")]
+
+def write_report(state: ResearchGraphState):
+
+    """ Node to write the final report body """
+
+    report = llm.invoke(report_messages(state)) 
+    return {"content": report.content}
+
+async def awrite_report(state: ResearchGraphState):
+
+    """ Node to write the final report body """
+
+    report = await llm.ainvoke(report_messages(state)) 
     return {"content": report.content}
 
 # Write the introduction or conclusion
@@ -467,9 +579,7 @@ For your conclusion, use ## Conclusion as the section header.
 
 Here are the sections to reflect on for writing: {formatted_str_sections}"""
 
-def write_introduction(state: ResearchGraphState):
-
-    """ Node to write the introduction """
+def intro_conclusion_messages(state: ResearchGraphState, part: str) -> list:
 
     # Full set of sections
     sections = state["sections"]
@@ -481,24 +591,34 @@ def write_introduction(state: ResearchGraphState):
     # Summarize the sections into a final report
     
     instructions = intro_conclusion_instructions.format(topic=topic, formatted_str_sections=formatted_str_sections)    
-    intro = llm.invoke([instructions]+[HumanMessage(content=f"Write the report introduction")]) 
+    return [instructions]+[HumanMessage(content=f"Write the report {part}")]
+
+def write_introduction(state: ResearchGraphState):
+
+    """ Node to write the introduction """
+
+    intro = llm.invoke(intro_conclusion_messages(state, "introduction")) 
+    return {"introduction": intro.content}
+
+async def awrite_introduction(state: ResearchGraphState):
+
+    """ Node to write the introduction """
+
+    intro = await llm.ainvoke(intro_conclusion_messages(state, "introduction")) 
     return {"introduction": intro.content}
 
 def write_conclusion(state: ResearchGraphState):
 
     """ Node to write the conclusion """
 
-    # Full set of sections
-    sections = state["sections"]
-    topic = state["topic"]
+    conclusion = llm.invoke(intro_conclusion_messages(state, "conclusion")) 
+    return {"conclusion": conclusion.content}
 
-    # Concat all sections together
-    formatted_str_sections = "\n\n".join([f"{section}" for section in sections])
-    
-    # Summarize the sections into a final report
-    
-    instructions = intro_conclusion_instructions.format(topic=topic, formatted_str_sections=formatted_str_sections)    
-    conclusion = llm.invoke([instructions]+[HumanMessage(content=f"Write the report conclusion")]) 
+async def awrite_conclusion(state: ResearchGraphState):
+
+    """ Node to write the conclusion """
+
+    conclusion = await llm.ainvoke(intro_conclusion_messages(state, "conclusion")) 
     return {"conclusion": conclusion.content}
 
 def finalize_report(state: ResearchGraphState):
@@ -524,12 +644,12 @@ def finalize_report(state: ResearchGraphState):
 
 # Add nodes and edges 
 builder = StateGraph(ResearchGraphState)
-builder.add_node("create_analysts", create_analysts)
+builder.add_node("create_analysts", RunnableLambda(create_analysts, acreate_analysts))
 builder.add_node("human_feedback", human_feedback)
 builder.add_node("conduct_interview", interview_builder.compile())
-builder.add_node("write_report",write_report)
-builder.add_node("write_introduction",write_introduction)
-builder.add_node("write_conclusion",write_conclusion)
+builder.add_node("write_report", RunnableLambda(write_report, awrite_report))
+builder.add_node("write_introduction", RunnableLambda(write_introduction, awrite_introduction))
+builder.add_node("write_conclusion", RunnableLambda(write_conclusion, awrite_conclusion))
 builder.add_node("finalize_report",finalize_report)
 
 # Logic
@@ -543,4 +663,5 @@ builder.add_edge(["write_conclusion", "write_report", "write_introduction"], "fi
 builder.add_edge("finalize_report", END)
 
 # Compile
-graph = builder.compile(interrupt_before=['human_feedback'])
\ No newline at end of file
+# max_concurrency gates the tasks of each step, so at the fan-out step it bounds concurrent interviews
+graph = instrument(builder.compile(interrupt_before=['human_feedback']).with_config(max_concurrency=max_concurrent_interviews), "research_assistant")
\ No newline at end of file
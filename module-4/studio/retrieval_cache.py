@@ -0,0 +1,92 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+class RetrievalCache:
+
+    """ On-disk cache of retrieved documents, keyed by source and normalized query """
+
+    def __init__(self, path: str, ttl_seconds: float = 24 * 60 * 60, max_entries: int = 10_000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS retrieval_cache ("
+            "key TEXT PRIMARY KEY, source TEXT, query TEXT, docs TEXT, created_at REAL, accessed_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS retrieval_cache_lru ON retrieval_cache (accessed_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        # Case, punctuation and spacing differences should not cause a miss
+        return " ".join(re.findall(r"\w+", query.lower()))
+
+    def _key(self, source: str, query: str) -> str:
+        return f"{source}:{self.normalize(query)}"
+
+    def get(self, source: str, query: str):
+        """ Return the cached docs for this source and query, or None on a miss """
+        key = self._key(source, query)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT docs, created_at FROM retrieval_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM retrieval_cache WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE retrieval_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, source: str, query: str, docs: list):
+        """ Store docs for this source and query, evicting the least recently used entries """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO retrieval_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (self._key(source, query), source, self.normalize(query), json.dumps(docs), now, now),
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM retrieval_cache").fetchone()
+            if count > self.max_entries:
+                cursor = self._conn.execute(
+                    "DELETE FROM retrieval_cache WHERE key IN "
+                    "(SELECT key FROM retrieval_cache ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+                self.evictions += cursor.rowcount
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        """ Hit / miss counters, e.g. to expose as metrics """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+# Shared by every retriever in the studio graphs; disabled unless RETRIEVAL_CACHE_PATH is set
+retrieval_cache = (
+    RetrievalCache(
+        os.environ["RETRIEVAL_CACHE_PATH"],
+        ttl_seconds=float(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", 24 * 60 * 60)),
+        max_entries=int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", "10000")),
+    )
+    if os.getenv("RETRIEVAL_CACHE_PATH")
+    else None
+)
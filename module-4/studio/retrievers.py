@@ -0,0 +1,153 @@
+import asyncio
+import os
+from functools import lru_cache
+
+from cassette import cassette
+from http_clients import http_async_client, http_client
+from local_index import LocalIndex
+from retrieval_cache import retrieval_cache
+
+# "live" searches Tavily and Wikipedia, "local" serves both from prebuilt indexes (see local_index.py)
+retrieval_backend = os.getenv("RETRIEVAL_BACKEND", "live")
+
+@lru_cache
+def local_index(name: str) -> LocalIndex:
+    return LocalIndex(os.environ[f"LOCAL_{name.upper()}_INDEX_PATH"], max_df=float(os.getenv("LOCAL_INDEX_MAX_DF", "0.5")))
+
+# Web search results are {"url", "content"} dicts, as returned by Tavily
+
+def local_web_docs(query: str) -> list:
+    return [{"url": doc["source"], "content": doc["content"]} for doc in local_index("web").search(query, k=3)]
+
+# Live searches go over the shared keep-alive pool instead of a new client per call, and through the retrieval cache when it is enabled
+
+def _cached(source: str, query: str, fetch) -> list:
+    if retrieval_cache is None:
+        return fetch()
+    search_docs = retrieval_cache.get(source, query)
+    if search_docs is None:
+        search_docs = fetch()
+        retrieval_cache.set(source, query, search_docs)
+    return search_docs
+
+async def _acached(source: str, query: str, afetch) -> list:
+    # The cache is SQLite on disk, so its lookups run off the event loop
+    if retrieval_cache is None:
+        return await afetch()
+    search_docs = await asyncio.to_thread(retrieval_cache.get, source, query)
+    if search_docs is None:
+        search_docs = await afetch()
+        await asyncio.to_thread(retrieval_cache.set, source, query, search_docs)
+    return search_docs
+
+tavily_url = "https://api.tavily.com/search"
+
+def _tavily_request(query: str) -> dict:
+    return {"api_key": os.environ["TAVILY_API_KEY"], "query": query, "max_results": 3, "search_depth": "advanced"}
+
+def _tavily_results(response) -> list:
+    # Same fields TavilySearchResults keeps
+    response.raise_for_status()
+    return [
+        {"title": result["title"], "url": result["url"], "content": result["content"], "score": result["score"]}
+        for result in response.json()["results"]
+    ]
+
+def _tavily_docs(query: str) -> list:
+    return _cached("tavily", query, lambda: _tavily_results(http_client.post(tavily_url, json=_tavily_request(query))))
+
+async def _atavily_docs(query: str) -> list:
+    async def afetch():
+        return _tavily_results(await http_async_client.post(tavily_url, json=_tavily_request(query)))
+    return await _acached("tavily", query, afetch)
+
+def search_web_docs(query: str) -> list:
+    """ Retrieve docs from web search """
+    if retrieval_backend == "local":
+        return local_web_docs(query)
+    if cassette is not None:
+        return cassette.call("tavily", query, lambda: _tavily_docs(query))
+    return _tavily_docs(query)
+
+async def asearch_web_docs(query: str) -> list:
+    """ Retrieve docs from web search """
+    if retrieval_backend == "local":
+        # Searching the index is CPU work, so keep it off the event loop
+        return await asyncio.to_thread(local_web_docs, query)
+    if cassette is not None:
+        return await cassette.acall("tavily", query, lambda: _atavily_docs(query))
+    return await _atavily_docs(query)
+
+# Wikipedia results are {"page_content", "metadata"} dicts, mirroring WikipediaLoader documents
+
+def local_wikipedia_docs(query: str) -> list:
+    return [
+        {"page_content": doc["content"], "metadata": {"source": doc["source"], "title": doc["title"]}}
+        for doc in local_index("wikipedia").search(query, k=2)
+    ]
+
+wikipedia_url = "https://en.wikipedia.org/w/api.php"
+# Wikimedia asks API clients to identify themselves with a descriptive User-Agent and a contact
+wikipedia_headers = {
+    "User-Agent": os.getenv("WIKIPEDIA_USER_AGENT") or "langchain-academy-research-assistant/1.0 (https://github.com/langchain-ai/langchain-academy)"
+}
+# Page text is truncated like WikipediaLoader's doc_content_chars_max
+wikipedia_max_chars = 4000
+
+def _wikipedia_search_params(query: str) -> dict:
+    return {"action": "query", "list": "search", "srsearch": query, "srlimit": 2, "format": "json"}
+
+def _wikipedia_page_params(title: str) -> dict:
+    # TextExtracts returns only one full-page extract per request, so each title is fetched on its own
+    return {
+        "action": "query", "prop": "extracts|info", "explaintext": 1, "inprop": "url",
+        "titles": title, "redirects": 1, "format": "json",
+    }
+
+def _wikipedia_titles(response) -> list:
+    response.raise_for_status()
+    return [result["title"] for result in response.json()["query"]["search"]]
+
+def _wikipedia_page(response) -> list:
+    # A list with the page's doc, or an empty list if the page has no text (e.g. it was deleted)
+    response.raise_for_status()
+    return [
+        {"page_content": page["extract"][:wikipedia_max_chars], "metadata": {"title": page["title"], "source": page["fullurl"]}}
+        for page in response.json()["query"]["pages"].values()
+        if "extract" in page
+    ]
+
+def _wikipedia_docs(query: str) -> list:
+    def fetch():
+        titles = _wikipedia_titles(http_client.get(wikipedia_url, params=_wikipedia_search_params(query), headers=wikipedia_headers))
+        return [
+            doc
+            for title in titles
+            for doc in _wikipedia_page(http_client.get(wikipedia_url, params=_wikipedia_page_params(title), headers=wikipedia_headers))
+        ]
+    return _cached("wikipedia", query, fetch)
+
+async def _awikipedia_docs(query: str) -> list:
+    async def afetch():
+        titles = _wikipedia_titles(await http_async_client.get(wikipedia_url, params=_wikipedia_search_params(query), headers=wikipedia_headers))
+        responses = await asyncio.gather(
+            *(http_async_client.get(wikipedia_url, params=_wikipedia_page_params(title), headers=wikipedia_headers) for title in titles)
+        )
+        return [doc for response in responses for doc in _wikipedia_page(response)]
+    return await _acached("wikipedia", query, afetch)
+
+def search_wikipedia_docs(query: str) -> list:
+    """ Retrieve docs from wikipedia """
+    if retrieval_backend == "local":
+        return local_wikipedia_docs(query)
+    if cassette is not None:
+        return cassette.call("wikipedia", query, lambda: _wikipedia_docs(query))
+    return _wikipedia_docs(query)
+
+async def asearch_wikipedia_docs(query: str) -> list:
+    """ Retrieve docs from wikipedia """
+    if retrieval_backend == "local":
+        return await asyncio.to_thread(local_wikipedia_docs, query)
+    if cassette is not None:
+        return await cassette.acall("wikipedia", query, lambda: _awikipedia_docs(query))
+    return await _awikipedia_docs(query)
@@ -0,0 +1,230 @@
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from pydantic import ConfigDict
+
+from langchain_core.language_models import BaseChatModel
+
+from context_store import estimate_tokens
+
+def is_rate_limit_error(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+def _used_tokens(result):
+    usage = [generation.message.usage_metadata for generation in result.generations if generation.message.usage_metadata]
+    return sum(u["total_tokens"] for u in usage) if usage else None
+
+class TokenBucket:
+
+    """ Bucket refilled continuously at per_minute units per minute; the balance may go negative to record debt.
+    A per_minute of math.inf never limits. """
+
+    def __init__(self, per_minute: float = math.inf):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if math.isinf(self.rate):
+            return
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # A single request larger than the bucket is let through once the bucket is full
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+class AdaptiveScheduler:
+
+    """ Shared gate for model calls: token buckets on requests/min and tokens/min, plus AIMD concurrency that halves on 429s """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_concurrency: int = 32, max_retries: int = 6):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        # Callbacks that wake calls waiting for a concurrency slot, first come first served. Sync and async
+        # callers (on any event loop) share the scheduler, so each waiter brings its own way to be woken.
+        self._waiters = deque()
+
+    def _try_acquire(self, tokens: int, waiter) -> Optional[float]:
+        """ Take a slot and budget for one call and return 0, or return how long to wait before trying again.
+        None means there is no free slot: waiter is queued and called once a slot is released. """
+        with self._lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            if self.in_flight >= int(self.limit):
+                self._waiters.append(waiter)
+                return None
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait > 0:
+                return wait
+            self.in_flight += 1
+            self.requests.level -= 1
+            self.tokens.level -= tokens
+            return 0.0
+
+    def _wake(self) -> list:
+        # Called with the lock held: dequeue one waiter per free slot
+        free = int(self.limit) - self.in_flight
+        return [self._waiters.popleft() for _ in range(max(0, min(free, len(self._waiters))))]
+
+    def _abandon(self, waiter):
+        """ A waiter gave up (its call was cancelled); if it had already been woken, pass the slot on """
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return
+            woken = self._wake()
+        for wake in woken:
+            wake()
+
+    def _release(self, estimated_tokens: int, used_tokens: int = None, rate_limited: bool = False, completed: bool = True):
+        with self._lock:
+            self.in_flight -= 1
+            if used_tokens is not None:
+                # Settle the estimate against what the provider actually counted
+                self.tokens.level -= used_tokens - estimated_tokens
+            if rate_limited:
+                self.rate_limited += 1
+                self.limit = max(1.0, self.limit / 2)
+            elif completed:
+                # Additive increase: about one extra slot per `limit` successful calls
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            woken = self._wake()
+        for wake in woken:
+            wake()
+
+    def _backoff(self, attempt: int) -> float:
+        return min(60.0, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def _acquire(self, tokens: int):
+        while True:
+            released = threading.Event()
+            wait = self._try_acquire(tokens, released.set)
+            if wait == 0:
+                return
+            released.wait(wait)
+
+    async def _aacquire(self, tokens: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            released = loop.create_future()
+            def wake(released=released):
+                try:
+                    loop.call_soon_threadsafe(lambda: released.done() or released.set_result(None))
+                except RuntimeError:
+                    # The waiter's event loop has closed
+                    pass
+            wait = self._try_acquire(tokens, wake)
+            if wait == 0:
+                return
+            if wait is not None:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                await released
+            except asyncio.CancelledError:
+                self._abandon(wake)
+                raise
+
+    def run(self, call, estimated_tokens: int):
+        """ Run call() once the quotas allow it, retrying on 429s """
+        for attempt in range(self.max_retries + 1):
+            self._acquire(estimated_tokens)
+            used_tokens, rate_limited, completed = None, False, False
+            try:
+                result = call()
+            except Exception as error:
+                rate_limited, completed = is_rate_limit_error(error), True
+                if not rate_limited or attempt == self.max_retries:
+                    raise
+            else:
+                used_tokens, completed = _used_tokens(result), True
+                return result
+            finally:
+                # Also runs when the call is interrupted, so the slot is always given back
+                self._release(estimated_tokens, used_tokens, rate_limited, completed)
+            time.sleep(self._backoff(attempt))
+
+    async def arun(self, acall, estimated_tokens: int):
+        """ Async version of run, where acall() returns an awaitable """
+        for attempt in range(self.max_retries + 1):
+            await self._aacquire(estimated_tokens)
+            used_tokens, rate_limited, completed = None, False, False
+            try:
+                result = await acall()
+            except Exception as error:
+                rate_limited, completed = is_rate_limit_error(error), True
+                if not rate_limited or attempt == self.max_retries:
+                    raise
+            else:
+                used_tokens, completed = _used_tokens(result), True
+                return result
+            finally:
+                # Also runs when the call is cancelled (CancelledError is not an Exception), so the slot is always given back
+                self._release(estimated_tokens, used_tokens, rate_limited, completed)
+            await asyncio.sleep(self._backoff(attempt))
+
+class ScheduledChatModel(BaseChatModel):
+
+    """ Drop-in chat model that routes every call to the wrapped model through a shared AdaptiveScheduler """
+
+    model: BaseChatModel
+    scheduler: AdaptiveScheduler
+    # Budgeted output tokens per call until the provider reports real usage
+    expected_output_tokens: int = 500
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    @property
+    def _llm_type(self) -> str:
+        return f"scheduled-{self.model._llm_type}"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return self.model._identifying_params
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(**self.model.bind_tools(tools, **kwargs).kwargs)
+
+    def _estimate(self, messages) -> int:
+        return sum(estimate_tokens(str(message.content)) for message in messages) + self.expected_output_tokens
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return self.scheduler.run(lambda: self.model._generate(messages, stop=stop, **kwargs), self._estimate(messages))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return await self.scheduler.arun(lambda: self.model._agenerate(messages, stop=stop, **kwargs), self._estimate(messages))
+
+# Shared by every model in the process, so all Send() branches draw on one provider quota.
+# Disabled unless a quota is configured; a quota that is not set is unlimited.
+scheduler = (
+    AdaptiveScheduler(
+        requests_per_minute=float(os.getenv("MODEL_REQUESTS_PER_MINUTE") or math.inf),
+        tokens_per_minute=float(os.getenv("MODEL_TOKENS_PER_MINUTE") or math.inf),
+        max_concurrency=int(os.getenv("MODEL_MAX_CONCURRENCY", "32")),
+    )
+    if os.getenv("MODEL_REQUESTS_PER_MINUTE") or os.getenv("MODEL_TOKENS_PER_MINUTE")
+    else None
+)
+
+# Extra arguments for models passed to use_scheduler: the scheduler retries 429s itself, so the client must not as well
+scheduled_model_kwargs = {"max_retries": 0} if scheduler is not None else {}
+
+def use_scheduler(model: BaseChatModel) -> BaseChatModel:
+    """ Wrap a chat model in the shared scheduler when a quota is configured, otherwise return it unchanged """
+    return ScheduledChatModel(model=model, scheduler=scheduler) if scheduler is not None else model
@@ -0,0 +1,126 @@
+import hashlib
+import mmap
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+@dataclass(frozen=True)
+class SharedRef:
+
+    """ Small handle to a read-only value in the shared store; this, not the value, is what state and checkpoints hold """
+
+    key: str
+
+    def get(self):
+        return shared_store.get(self.key)
+
+class SharedStore:
+
+    """ Content-addressed store of large read-only values, memory-mapped so every reader shares one copy.
+
+    Values are pickled with out-of-band buffers, so numpy arrays are written as raw files and loaded back
+    as read-only views over a shared mapping instead of being copied. Entries not stored or loaded for
+    ttl_seconds are removed; a checkpoint that still points at one can no longer be resumed.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float = 7 * 24 * 60 * 60, max_entries: int = 16):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        # Values kept open in this process, least recently used first
+        self.max_entries = max_entries
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def put(self, value) -> SharedRef:
+        buffers = []
+        data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+        digest = hashlib.sha256(data)
+        for buffer in buffers:
+            digest.update(buffer.raw())
+        key = digest.hexdigest()
+        directory = os.path.join(self.path, key)
+        if os.path.exists(directory):
+            self._touch(directory)
+        else:
+            # Write under a temporary name and rename, so readers never see a partial entry
+            staging = f"{directory}.{os.getpid()}.{threading.get_ident()}"
+            os.makedirs(staging)
+            with open(os.path.join(staging, "value.pkl"), "wb") as file:
+                file.write(data)
+            for index, buffer in enumerate(buffers):
+                with open(os.path.join(staging, f"{index}.buf"), "wb") as file:
+                    file.write(buffer.raw())
+            try:
+                os.rename(staging, directory)
+            except OSError:
+                # Another writer stored the same content first
+                shutil.rmtree(staging, ignore_errors=True)
+            self.prune()
+        return SharedRef(key)
+
+    @staticmethod
+    def _touch(directory: str):
+        # prune goes by mtime, so mark the entry as still in use
+        try:
+            os.utime(directory)
+        except FileNotFoundError:
+            pass
+
+    def _load(self, key: str):
+        directory = os.path.join(self.path, key)
+        if not os.path.exists(directory):
+            raise KeyError(f"shared value {key} is not in {self.path}; it may have expired")
+        self._touch(directory)
+        with open(os.path.join(directory, "value.pkl"), "rb") as file:
+            data = file.read()
+        buffers = []
+        index = 0
+        while os.path.exists(buffer_path := os.path.join(directory, f"{index}.buf")):
+            with open(buffer_path, "rb") as file:
+                # Empty files cannot be mapped
+                buffers.append(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(buffer_path) else b"")
+            index += 1
+        return pickle.loads(data, buffers=buffers)
+
+    def get(self, key: str):
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key]
+        value = self._load(key)
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+        return value
+
+    def prune(self):
+        """ Remove entries not stored or loaded in the last ttl_seconds """
+        cutoff = time.time() - self.ttl_seconds
+        for entry in os.scandir(self.path):
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+# Shared by the studio graphs; disabled unless SHARED_REF_PATH is set
+shared_store = (
+    SharedStore(
+        os.environ["SHARED_REF_PATH"],
+        ttl_seconds=float(os.getenv("SHARED_REF_TTL_SECONDS", 7 * 24 * 60 * 60)),
+        max_entries=int(os.getenv("SHARED_REF_MAX_ENTRIES", "16")),
+    )
+    if os.getenv("SHARED_REF_PATH")
+    else None
+)
+
+def share(value):
+    """ Put a value in the shared store and return its SharedRef, or return the value unchanged when the store is disabled """
+    return shared_store.put(value) if shared_store is not None else value
+
+def resolve(value):
+    """ The value behind a SharedRef; anything else is returned as is """
+    return value.get() if isinstance(value, SharedRef) else value
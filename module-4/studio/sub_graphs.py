@@ -1,8 +1,19 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, reduce
 from operator import add
-from typing import List, Optional, Annotated
+from typing import Any, List, Optional, Annotated, Union
 from typing_extensions import TypedDict
+from langgraph.constants import Send
 from langgraph.graph import StateGraph, START, END
 
+from instrumentation import instrument
+from log_batch import LogBatch, ProcessedLogs, append_processed_logs, read_log_chunk
+from log_memo import log_memo
+from failure_analysis import FailureAnalysisOutputState, analyze_shard, fa_graph, get_failures
+from shared_refs import SharedRef, resolve, share
+
 # The structure of the logs
 class Log(TypedDict):
     id: str
@@ -13,57 +24,85 @@ class Log(TypedDict):
     grader: Optional[str]
     feedback: Optional[str]
 
-# Failure Analysis Sub-graph
-class FailureAnalysisState(TypedDict):
-    cleaned_logs: List[Log]
-    failures: List[Log]
-    fa_summary: str
-    processed_logs: List[str]
+# Failure Analysis Sub-graph: in failure_analysis.py, so worker processes can import it without this module
+
+# Sharded Failure Analysis Sub-graph: the same analysis, run on shards of cleaned_logs in worker processes
+failure_analysis_shards = int(os.getenv("FAILURE_ANALYSIS_SHARDS", "1"))
+failure_analysis_workers = int(os.getenv("FAILURE_ANALYSIS_WORKERS", "0")) or None # None: one per CPU
 
-class FailureAnalysisOutputState(TypedDict):
+# Workers are never forked from this process, which runs graph threads (forking it could copy a held lock).
+# forkserver forks them from a clean single-threaded server instead, and spawn starts them from scratch.
+failure_analysis_start_method = os.getenv("FAILURE_ANALYSIS_START_METHOD") or (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+@lru_cache
+def process_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=failure_analysis_workers, mp_context=multiprocessing.get_context(failure_analysis_start_method))
+
+class ShardedFailureAnalysisState(TypedDict):
+    cleaned_logs: Union[LogBatch, SharedRef]
     fa_summary: str
-    processed_logs: List[str]
+    shard_results: Annotated[list, add]
+    processed_logs: ProcessedLogs
 
-def get_failures(state):
-    """ Get logs that contain a failure """
-    cleaned_logs = state["cleaned_logs"]
-    failures = [log for log in cleaned_logs if "grade" in log]
-    return {"failures": failures}
+class ShardState(TypedDict):
+    cleaned_logs: Union[LogBatch, SharedRef]
+    rows: Optional[tuple]  # (start, stop) within cleaned_logs, or None for all of it
 
-def generate_summary(state):
-    """ Generate summary of failures """
-    failures = state["failures"]
-    # Add fxn: fa_summary = summarize(failures)
-    fa_summary = "Poor quality retrieval of Chroma documentation."
-    return {"fa_summary": fa_summary, "processed_logs": [f"failure-analysis-on-log-{failure['id']}" for failure in failures]}
-
-fa_builder = StateGraph(input=FailureAnalysisState,output=FailureAnalysisOutputState)
-fa_builder.add_node("get_failures", get_failures)
-fa_builder.add_node("generate_summary", generate_summary)
-fa_builder.add_edge(START, "get_failures")
-fa_builder.add_edge("get_failures", "generate_summary")
-fa_builder.add_edge("generate_summary", END)
+def split_shards(state):
+    """ Send contiguous shards of cleaned_logs to the workers """
+    cleaned_logs = state["cleaned_logs"]
+    shards = max(1, min(failure_analysis_shards, len(resolve(cleaned_logs))))
+    bounds = [len(resolve(cleaned_logs)) * i // shards for i in range(shards + 1)]
+    if isinstance(cleaned_logs, SharedRef):
+        # Workers map the shared batch themselves, so each shard is just the ref and its row range
+        return [Send("analyze_failures", {"cleaned_logs": cleaned_logs, "rows": (start, stop)}) for start, stop in zip(bounds[:-1], bounds[1:])]
+    return [
+        Send("analyze_failures", {"cleaned_logs": cleaned_logs.take(range(start, stop)), "rows": None})
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+
+def analyze_failures(state: ShardState):
+    # Shards run in parallel across Send() branches; each one blocks only its own branch thread
+    result = process_pool().submit(analyze_shard, state["cleaned_logs"], state["rows"]).result()
+    return {"shard_results": [result]}
+
+def merge_shards(state):
+    """ Combine the shard summaries and processed logs """
+    shard_results = state["shard_results"]
+    # Add fxn: fa_summary = summarize([result["fa_summary"] for result in shard_results], previous=state.get("fa_summary"))
+    fa_summary = shard_results[0]["fa_summary"]
+    processed_logs = reduce(append_processed_logs, [result["processed_logs"] for result in shard_results], ProcessedLogs())
+    return {"fa_summary": fa_summary, "processed_logs": processed_logs}
+
+sharded_fa_builder = StateGraph(input=ShardedFailureAnalysisState,output=FailureAnalysisOutputState)
+sharded_fa_builder.add_node("analyze_failures", analyze_failures)
+sharded_fa_builder.add_node("merge_shards", merge_shards)
+sharded_fa_builder.add_conditional_edges(START, split_shards, ["analyze_failures"])
+sharded_fa_builder.add_edge("analyze_failures", "merge_shards")
+sharded_fa_builder.add_edge("merge_shards", END)
 
 # Summarization subgraph
 class QuestionSummarizationState(TypedDict):
-    cleaned_logs: List[Log]
+    cleaned_logs: Union[LogBatch, SharedRef]
     qs_summary: str
     report: str
-    processed_logs: List[str]
+    processed_logs: ProcessedLogs
 
 class QuestionSummarizationOutputState(TypedDict):
     report: str
-    processed_logs: List[str]
+    processed_logs: ProcessedLogs
 
 def generate_summary(state):
-    cleaned_logs = state["cleaned_logs"]
+    cleaned_logs = resolve(state["cleaned_logs"])
     # Add fxn: summary = summarize(generate_summary)
     summary = "Questions focused on usage of ChatOllama and Chroma vector store."
-    return {"qs_summary": summary, "processed_logs": [f"summary-on-log-{log['id']}" for log in cleaned_logs]}
+    return {"qs_summary": summary, "processed_logs": ProcessedLogs.segment("summary-on-log-", cleaned_logs.id)}
 
 def send_to_slack(state):
     qs_summary = state["qs_summary"]
-    # Add fxn: report = report_generation(qs_summary)
+    # Add fxn: report = report_generation(qs_summary, previous=state.get("report"))
     report = "foo bar baz"
     return {"report": report}
 
@@ -76,28 +115,79 @@ qs_builder.add_edge("send_to_slack", END)
 
 # Entry Graph
 class EntryGraphState(TypedDict):
-    raw_logs: List[Log]
-    cleaned_logs: List[Log]
+    raw_logs: Union[List[Log], LogBatch]
+    cleaned_logs: Union[LogBatch, SharedRef]
     fa_summary: str # This will only be generated in the FA sub-graph
     report: str # This will only be generated in the QS sub-graph
-    processed_logs:  Annotated[List[int], add] # This will be generated in BOTH sub-graphs
+    processed_logs:  Annotated[ProcessedLogs, append_processed_logs] # This will be generated in BOTH sub-graphs
+    log_source: Any # Optional: a .jsonl / .parquet path or an iterator of logs, read in chunks instead of raw_logs
+    log_cursor: int # Where the next chunk of log_source starts
+    logs_exhausted: bool
+
+# Streaming mode: logs per chunk, and how many chunks one run may loop through
+log_chunk_size = int(os.getenv("LOG_CHUNK_SIZE", "10000"))
+max_log_chunks = int(os.getenv("MAX_LOG_CHUNKS", "10000"))
 
 def clean_logs(state):
     # Get logs
-    raw_logs = state["raw_logs"]
+    if state.get("log_source") is not None:
+        # Only one chunk is held at a time; both subgraphs run on it before the next is read
+        raw_logs, log_cursor = read_log_chunk(state["log_source"], state.get("log_cursor", 0), log_chunk_size)
+        exhausted = len(raw_logs) < log_chunk_size
+    else:
+        raw_logs, log_cursor, exhausted = state["raw_logs"], 0, True
     # Data cleaning raw_logs -> docs 
-    cleaned_logs = raw_logs
-    return {"cleaned_logs": cleaned_logs}
+    # Both subgraphs read the columnar form
+    cleaned_logs = raw_logs if isinstance(raw_logs, LogBatch) else LogBatch.from_logs(raw_logs)
+    update = {}
+    if log_memo is not None:
+        # Incremental mode: logs seen before with the same content reuse their recorded results,
+        # and only the new or changed ones go through the subgraphs
+        changed, failures = log_memo.lookup(cleaned_logs)
+        unchanged = cleaned_logs.filter(~changed)
+        update["processed_logs"] = append_processed_logs(
+            ProcessedLogs.segment("failure-analysis-on-log-", cleaned_logs.filter(failures).id),
+            ProcessedLogs.segment("summary-on-log-", unchanged.id),
+        )
+        if state.get("fa_summary") is None:
+            # The subgraphs fold the new logs into the summaries of earlier runs
+            update.update(log_memo.summaries())
+        cleaned_logs = cleaned_logs.filter(changed)
+    # With a shared store, both subgraphs and every checkpoint hold a small SharedRef instead of a copy
+    return {**update, "cleaned_logs": share(cleaned_logs), "log_cursor": log_cursor, "logs_exhausted": exhausted}
+
+def analyze_chunk(state):
+    # Skip the subgraphs when there is nothing to analyze: a streamed source that ended exactly on a chunk
+    # boundary, or a chunk with no new logs in incremental mode
+    if (state.get("log_source") is not None or log_memo is not None) and len(resolve(state["cleaned_logs"])) == 0:
+        return next_chunk(state)
+    return ["failure_analysis", "question_summarization"]
+
+def record_logs(state):
+    """ Incremental mode: remember the logs just analyzed and the updated summaries """
+    cleaned_logs = resolve(state["cleaned_logs"])
+    log_memo.record(cleaned_logs, get_failures({"cleaned_logs": cleaned_logs})["failures"])
+    log_memo.save_summaries({"fa_summary": state["fa_summary"], "report": state["report"]})
+    return {}
+
+def next_chunk(state):
+    return END if state["logs_exhausted"] else "clean_logs"
 
 entry_builder = StateGraph(EntryGraphState)
 entry_builder.add_node("clean_logs", clean_logs)
 entry_builder.add_node("question_summarization", qs_builder.compile())
-entry_builder.add_node("failure_analysis", fa_builder.compile())
+entry_builder.add_node("failure_analysis", sharded_fa_builder.compile() if failure_analysis_shards > 1 else fa_graph)
 
 entry_builder.add_edge(START, "clean_logs")
-entry_builder.add_edge("clean_logs", "failure_analysis")
-entry_builder.add_edge("clean_logs", "question_summarization")
-entry_builder.add_edge("failure_analysis", END)
-entry_builder.add_edge("question_summarization", END)
-
-graph = entry_builder.compile()
\ No newline at end of file
+entry_builder.add_conditional_edges("clean_logs", analyze_chunk, ["failure_analysis", "question_summarization", "clean_logs", END])
+if log_memo is not None:
+    entry_builder.add_node("record_logs", record_logs)
+    entry_builder.add_edge("failure_analysis", "record_logs")
+    entry_builder.add_edge("question_summarization", "record_logs")
+    entry_builder.add_conditional_edges("record_logs", next_chunk, ["clean_logs", END])
+else:
+    entry_builder.add_conditional_edges("failure_analysis", next_chunk, ["clean_logs", END])
+    entry_builder.add_conditional_edges("question_summarization", next_chunk, ["clean_logs", END])
+
+# Each streamed chunk takes up to three steps: clean_logs, both subgraphs, then record_logs in incremental mode
+graph = instrument(entry_builder.compile().with_config(recursion_limit=3 * max_log_chunks + 1), "sub_graphs")
\ No newline at end of file